@@ -0,0 +1,92 @@
+import gzip
+import json
+import os
+import tempfile
+import time
+
+from storage import fsync_directory, to_epoch
+
+
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+# How often finished classes are moved out of the hot set; 0 disables it
+ARCHIVE_INTERVAL_SECONDS = float(os.environ.get("ARCHIVE_INTERVAL_SECONDS", "3600"))
+
+
+def _segments(directory):
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.endswith(".jsonl.gz"))
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, name) for name in names]
+
+
+def _write_segment(entries, path):
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    with os.fdopen(fd, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as file:
+            for entry in entries:
+                file.write(json.dumps(entry, separators=(",", ":")).encode() + b"\n")
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(temp_path, path)
+    fsync_directory(directory)
+
+
+def archive_past_classes(db, now=None, directory=ARCHIVE_DIR):
+    # Moves classes whose end_time has passed, together with their
+    # registrations, into a new gzip-compressed segment and drops them from the
+    # store. Returns the number of classes archived.
+    now = time.time() if now is None else now
+    finished = []
+    for f_class in db.all("fitness_classes"):
+        try:
+            if to_epoch(f_class["end_time"]) < now:
+                finished.append(f_class)
+        except ValueError:
+            continue
+    if not finished:
+        return 0
+
+    entries = [
+        {"class": f_class, "registrations": db.find("registrations", "class_id", f_class["class_id"])}
+        for f_class in finished
+    ]
+    os.makedirs(directory, exist_ok=True)
+    # Segment names sort by creation time; if two workers archive the same
+    # class, readers keep the one from the newest segment
+    path = os.path.join(directory, f"segment-{time.time_ns():020d}-{os.getpid()}.jsonl.gz")
+    _write_segment(entries, path)
+
+    # Only what was written to the segment is dropped, in one commit. A class
+    # that was edited or got a registration in the meantime stays in the
+    # store whole and is archived on a later run.
+    skipped = db.delete_unchanged([
+        [
+            ("fitness_classes", "class_id", entry["class"]["class_id"], [entry["class"]]),
+            ("registrations", "class_id", entry["class"]["class_id"], entry["registrations"]),
+        ]
+        for entry in entries
+    ])
+    if skipped:
+        # Take them out of the segment again, so it holds no stale copies
+        skipped_ids = {group[0][2] for group in skipped}
+        entries = [entry for entry in entries if entry["class"]["class_id"] not in skipped_ids]
+        if entries:
+            _write_segment(entries, path)
+        else:
+            os.unlink(path)
+            fsync_directory(directory)
+    return len(entries)
+
+
+def read_archive(directory=ARCHIVE_DIR):
+    # Streams the archived classes, decompressing one segment at a time, and
+    # returns {class_id: {"class": ..., "registrations": [...]}}
+    archived = {}
+    for path in _segments(directory):
+        with gzip.open(path, "rb") as file:
+            for line in file:
+                entry = json.loads(line)
+                archived[entry["class"]["class_id"]] = entry
+    return archived
@@ -0,0 +1,367 @@
+import hashlib
+import json
+import math
+import os
+import secrets
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from jose import JWTError, jwk, jwt
+
+try:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa as rsa_keys
+except ImportError:  # pure-Python fallback, much slower key generation
+    import rsa
+    rsa_keys = None
+
+
+PRINCIPAL_CACHE_SIZE = int(os.environ.get("PRINCIPAL_CACHE_SIZE", "10000"))
+PRINCIPAL_CACHE_TTL = float(os.environ.get("PRINCIPAL_CACHE_TTL", "60"))
+# Revoked tokens the Bloom filter is sized for before it is grown
+REVOCATION_CAPACITY = int(os.environ.get("REVOCATION_CAPACITY", "100000"))
+REFRESH_TOKEN_EXPIRE_DAYS = float(os.environ.get("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+
+# Access tokens are signed with RSA keys from a rotating set published at
+# /.well-known/jwks.json
+JWT_ALGORITHM = "RS256"
+JWT_KEY_BITS = int(os.environ.get("JWT_KEY_BITS", "2048"))
+JWT_KEY_ROTATION_DAYS = float(os.environ.get("JWT_KEY_ROTATION_DAYS", "30"))
+# How long verifiers may cache the key set; new keys are published this long
+# before they sign anything
+JWKS_MAX_AGE = int(os.environ.get("JWKS_MAX_AGE", "3600"))
+
+
+class PrincipalCache:
+    # Bounded LRU from an already verified access token to the user it
+    # resolved to. Entries expire after ttl seconds or when the token does,
+    # whichever comes first, and are dropped as soon as their user changes.
+    def __init__(self, maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # token -> (user_id, principal, expires_at)
+        self.tokens_by_user = {}
+
+    def get(self, token):
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                self._drop(token)
+                return None
+            self.entries.move_to_end(token)
+            return entry[1]
+
+    def put(self, token, user_id, principal, token_expires_at):
+        with self.lock:
+            if token in self.entries:
+                self._drop(token)
+            self.entries[token] = (user_id, principal, min(time.time() + self.ttl, token_expires_at))
+            self.tokens_by_user.setdefault(user_id, set()).add(token)
+            while len(self.entries) > self.maxsize:
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, token):
+        user_id = self.entries.pop(token)[0]
+        tokens = self.tokens_by_user[user_id]
+        tokens.discard(token)
+        if not tokens:
+            del self.tokens_by_user[user_id]
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            for token in self.tokens_by_user.pop(user_id, ()):
+                del self.entries[token]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tokens_by_user.clear()
+
+    def on_change(self, name, op, payload):
+        # Store listener: keeps the cache in step with user updates and deletes,
+        # including ones made by other workers
+        if name != "users":
+            return
+        if op == "reset":
+            self.clear()
+        else:
+            self.invalidate_user(payload["user_id"] if op == "put" else payload)
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RevocationList:
+    # Revoked token IDs (jti) and per-user "sessions revoked at" cutoffs, kept
+    # in the store's "revocations" collection so every worker sees them. The
+    # in-memory side answers is_revoked() without I/O: a Bloom filter rules
+    # out almost every live token, and only its hits reach the exact dict.
+    # Entries expire together with the tokens they revoke.
+    def __init__(self, store, capacity=REVOCATION_CAPACITY):
+        self.store = store
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        store.subscribe(self.on_change)
+        self.load()
+
+    def load(self):
+        with self.lock:
+            self.tokens = {}  # jti -> expires_at
+            self.user_cutoffs = {}  # user_id -> (not_before, expires_at)
+            for record in self.store.all("revocations"):
+                self._add(record)
+            self._rebuild()
+
+    def _rebuild(self):
+        while len(self.tokens) > self.capacity:
+            self.capacity *= 2
+        self.bloom = BloomFilter(self.capacity)
+        for jti in self.tokens:
+            self.bloom.add(jti)
+
+    def _add(self, record):
+        # Returns the jti if the record revokes a single token
+        if record.get("user_id") is not None:
+            self.user_cutoffs[record["user_id"]] = (record["not_before"], record["expires_at"])
+            return None
+        self.tokens[record["jti"]] = record["expires_at"]
+        return record["jti"]
+
+    def on_change(self, name, op, payload):
+        if name != "revocations":
+            return
+        if op == "reset":
+            self.load()
+            return
+        with self.lock:
+            if op == "put":
+                jti = self._add(payload)
+                if jti is not None:
+                    if len(self.tokens) > self.capacity:
+                        self._rebuild()
+                    else:
+                        self.bloom.add(jti)
+            elif payload.startswith("user:"):
+                self.user_cutoffs.pop(int(payload[len("user:"):]), None)
+            else:
+                # The Bloom filter keeps the bit until the next purge
+                self.tokens.pop(payload, None)
+
+    def is_revoked(self, jti, user_id, issued_at):
+        now = time.time()
+        cutoff = self.user_cutoffs.get(user_id)
+        # A token issued at the very instant of the cutoff counts as before it
+        if cutoff is not None and cutoff[1] > now and (issued_at or 0) <= cutoff[0]:
+            return True
+        if jti is None or jti not in self.bloom:
+            return False
+        expires_at = self.tokens.get(jti)
+        return expires_at is not None and expires_at > now
+
+    def revoke(self, jti, expires_at):
+        self.store.put("revocations", {"jti": jti, "expires_at": expires_at})
+
+    def revoke_user(self, user_id, lifetime):
+        # Rejects every token issued to the user before now; the entry can go
+        # once the last of those tokens would have expired anyway. Compared
+        # with the tokens' sub-second issued_at claim, so no token from the
+        # same second slips through.
+        now = time.time()
+        self.store.put("revocations", {
+            "jti": f"user:{user_id}",
+            "user_id": user_id,
+            "not_before": now,
+            "expires_at": now + lifetime,
+        })
+
+    def purge(self):
+        now = time.time()
+        for record in self.store.all("revocations"):
+            if record["expires_at"] <= now:
+                self.store.delete("revocations", record["jti"])
+        with self.lock:
+            self._rebuild()
+
+
+class InvalidRefreshToken(Exception):
+    pass
+
+
+class RefreshTokens:
+    # Long-lived opaque refresh tokens. Each login starts a family, kept as a
+    # single record in the "refresh_families" collection holding the hash of
+    # its one valid token. A token is "<family_id>.<secret>"; every refresh
+    # swaps the stored hash for that of the successor, so presenting any
+    # other token of the family means an old one leaked and revokes the
+    # family. The family expires a fixed time after login, however often it
+    # is refreshed.
+    def __init__(self, store, lifetime=REFRESH_TOKEN_EXPIRE_DAYS * 86400):
+        self.store = store
+        self.lifetime = lifetime
+
+    @staticmethod
+    def _hash(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    @staticmethod
+    def _new_token(family_id):
+        return f"{family_id}.{secrets.token_urlsafe(32)}"
+
+    def issue(self, user_id):
+        family_id = uuid.uuid4().hex
+        token = self._new_token(family_id)
+        self.store.put("refresh_families", {
+            "family_id": family_id,
+            "user_id": user_id,
+            "token_hash": self._hash(token),
+            "expires_at": time.time() + self.lifetime,
+        })
+        return token, family_id
+
+    def rotate(self, token):
+        # Returns (user_id, family_id, successor token)
+        family_id = token.partition(".")[0]
+        record = self.store.get("refresh_families", family_id)
+        if record is None or record["expires_at"] <= time.time():
+            raise InvalidRefreshToken()
+        successor = self._new_token(family_id)
+        # Only succeeds while the presented token is still the current one,
+        # so of two refreshes racing with the same token one is reuse
+        if self._hash(token) != record["token_hash"] or not self.store.update(
+            "refresh_families",
+            dict(record, token_hash=self._hash(successor)),
+            expected={"token_hash": record["token_hash"]},
+        ):
+            self.revoke_family(family_id)
+            raise InvalidRefreshToken()
+        return record["user_id"], family_id, successor
+
+    def _delete(self, records):
+        for record in records:
+            self.store.delete("refresh_families", record["family_id"])
+
+    def revoke_family(self, family_id):
+        self.store.delete("refresh_families", family_id)
+
+    def revoke_user(self, user_id):
+        self._delete(self.store.find("refresh_families", "user_id", user_id))
+
+    def purge(self):
+        now = time.time()
+        self._delete(record for record in self.store.all("refresh_families") if record["expires_at"] <= now)
+
+
+def generate_private_key(bits=JWT_KEY_BITS):
+    # PKCS#1 PEM, which every python-jose backend can load
+    if rsa_keys is None:
+        return rsa.newkeys(bits)[1].save_pkcs1().decode()
+    key = rsa_keys.generate_private_key(public_exponent=65537, key_size=bits)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption(),
+    ).decode()
+
+
+class SigningKeys:
+    # RSA key set for access tokens, kept in the store's "signing_keys"
+    # collection so every worker signs and verifies with the same keys. Keys
+    # are parsed once per process and the JWKS document is prebuilt; both are
+    # reloaded when the collection changes. A new key is added every rotation
+    # period but only signs once verifiers caching the old key set have had
+    # time to fetch it, and stays published until the last token it signed
+    # has expired.
+    def __init__(self, store, token_lifetime, rotation=JWT_KEY_ROTATION_DAYS * 86400, max_age=JWKS_MAX_AGE):
+        self.store = store
+        self.token_lifetime = token_lifetime
+        self.rotation = rotation
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        store.subscribe(self.on_change)
+        self.load()
+
+    def load(self):
+        keys = []
+        for record in sorted(self.store.all("signing_keys"), key=lambda record: (record["active_from"], record["kid"])):
+            private_key = jwk.construct(record["private_key"], JWT_ALGORITHM)
+            keys.append((record["kid"], record["active_from"], private_key, private_key.public_key()))
+        jwks = {"keys": [
+            dict(public_key.to_dict(), kid=kid, use="sig")
+            for kid, _, _, public_key in keys
+        ]}
+        with self.lock:
+            self.keys = keys
+            self.public_keys = {kid: public_key for kid, _, _, public_key in keys}
+            self.jwks = json.dumps(jwks).encode()
+
+    def on_change(self, name, op, payload):
+        if name == "signing_keys":
+            self.load()
+
+    def next_activation(self, now=None):
+        # When the key to generate next should start signing, or None if no
+        # key is due
+        now = time.time() if now is None else now
+        with self.lock:
+            keys = self.keys
+        active = [active_from for _, active_from, _, _ in keys if active_from <= now]
+        if not active:
+            return now
+        if keys[-1][1] > now or active[-1] + self.rotation > now + self.max_age:
+            return None
+        return now + self.max_age
+
+    def add(self, private_key, active_from):
+        self.store.put("signing_keys", {
+            "kid": uuid.uuid4().hex,
+            "private_key": private_key,
+            "active_from": active_from,
+            # Signs until its successor activates, at most a rotation period
+            # plus max_age later, then verifies the tokens it signed
+            "expires_at": active_from + self.rotation + self.max_age + self.token_lifetime,
+        })
+
+    def sign(self, claims):
+        now = time.time()
+        with self.lock:
+            keys = self.keys
+        kid, _, private_key, _ = next(
+            (key for key in reversed(keys) if key[1] <= now),
+            keys[0],
+        )
+        return jwt.encode(claims, private_key, algorithm=JWT_ALGORITHM, headers={"kid": kid})
+
+    def verify(self, token):
+        # Raises JWTError for unknown keys as for any other invalid token
+        kid = jwt.get_unverified_header(token).get("kid")
+        public_key = self.public_keys.get(kid)
+        if public_key is None:
+            raise JWTError("Unknown signing key")
+        return jwt.decode(token, public_key, algorithms=[JWT_ALGORITHM])
+
+    def purge(self):
+        now = time.time()
+        for record in self.store.all("signing_keys"):
+            if record["expires_at"] <= now:
+                self.store.delete("signing_keys", record["kid"])
@@ -1,44 +1,69 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
 from typing import List, Optional
+from typing_extensions import Annotated
 from typing import Optional
 from fastapi import HTTPException, Depends
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-import json
-from passlib.context import CryptContext
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
 from fastapi.security import OAuth2PasswordBearer
 from fastapi import status
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 from fastapi.middleware.cors import CORSMiddleware
+from storage import COLLECTIONS, ProjectionCache, RegistrationTable, open_store, to_epoch
+from archive import ARCHIVE_INTERVAL_SECONDS, archive_past_classes, read_archive
+from hashing import HashingBusy, configured_rounds, get_password_hash, get_password_hashes, hash_pool, needs_rehash, verify_password
+from auth import JWKS_MAX_AGE, InvalidRefreshToken, PrincipalCache, RefreshTokens, RevocationList, SigningKeys, generate_private_key
+from ratelimit import CLIENT_RATE_LIMIT, USERNAME_RATE_LIMIT, SlidingWindowLimiter
+from serialization import FastJSONResponse, ResponseCache, strip_variant
+from idempotency import IdempotencyKeys, IdempotencyMiddleware
+import base64
+from email.utils import formatdate, parsedate_to_datetime
+import json
+import os
+import time
+import uuid
+from fastapi.concurrency import run_in_threadpool
+import asyncio
 
 app = FastAPI()
 
-# Set up CORS middleware configuration
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:3000"],  # Allows all origins
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"],  # Allows all headers
-)
 
+@app.exception_handler(HashingBusy)
+async def hashing_busy_handler(request: Request, exc: HashingBusy):
+    # Every password hashing process is busy and the queue is full
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Server busy, please retry"},
+        headers={"Retry-After": "1"},
+    )
 
-# Password hashing context
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+@app.on_event("startup")
+async def configure_hash_pool():
+    hash_pool.configure(await run_in_threadpool(configured_rounds, db))
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+@app.on_event("shutdown")
+def stop_hash_pool():
+    hash_pool.shutdown()
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def rehash_password(user_id, password, old_hash):
+    # Brings a hash made at an outdated cost up to the configured one; skipped
+    # if the pool is busy (the next login tries again) or the password changed
+    try:
+        new_hash = await get_password_hash(password)
+    except HashingBusy:
+        return
+    user = db.get("users", user_id)
+    if user is not None and user["hashed_password"] == old_hash:
+        await run_in_threadpool(db.put, "users", dict(user, hashed_password=new_hash))
 
 
 
-SECRET_KEY = "TST1234" 
-ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Lifetime of tokens created without an explicit expiry
+DEFAULT_TOKEN_EXPIRE_HOURS = 12
 class User(BaseModel):
     user_id: int
     username: str
@@ -57,14 +82,21 @@ class Token(BaseModel):
     token_type: str = "bearer"
     user_id: int
     role: str
+    refresh_token: Optional[str] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
-    expire = datetime.utcnow() + expires_delta if expires_delta else datetime.utcnow() + timedelta(hours=12)
-    to_encode.update({"exp": expire})
+    now = datetime.utcnow()
+    expire = now + expires_delta if expires_delta else now + timedelta(hours=DEFAULT_TOKEN_EXPIRE_HOURS)
+    # jti identifies the token for revocation. iat is in whole seconds, so
+    # issued_at carries the exact time for comparing with session cutoffs.
+    to_encode.update({"exp": expire, "iat": now, "issued_at": time.time(), "jti": uuid.uuid4().hex})
     to_encode.update({"role": data["role"]}) 
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return signing_keys.sign(to_encode)
 
 # Models
 class Coach(BaseModel):
@@ -85,58 +117,157 @@ class FitnessClass(BaseModel):
     end_time: str
     class_type: str
 
+# The memory store packs registration IDs into 32 bits each
+RegistrationId = Annotated[int, Field(ge=-RegistrationTable.OFFSET, lt=RegistrationTable.OFFSET)]
+
 class Registration(BaseModel):
-    user_id: int
-    class_id: int
+    user_id: RegistrationId
+    class_id: RegistrationId
 
 class UserLoginRequest(BaseModel):
     username: str
     password: str
-# Utility functions to read and write JSON files
-def read_json(filename):
-    with open(filename, "r") as file:
-        return json.load(file)
 
-def write_json(data, filename):
-    with open(filename, "w") as file:
-        json.dump(data, file, indent=4)
+# Largest number of classes POST /registrations/batch takes per request
+REGISTRATION_BATCH_LIMIT = int(os.environ.get("REGISTRATION_BATCH_LIMIT", "200"))
 
+class RegistrationBatch(BaseModel):
+    # "register" would shadow BaseModel.register
+    register_ids: List[RegistrationId] = Field(default_factory=list, alias="register", max_length=REGISTRATION_BATCH_LIMIT)
+    cancel: List[RegistrationId] = Field(default_factory=list, max_length=REGISTRATION_BATCH_LIMIT)
+
+# A class as shown on a member's schedule
+class ScheduledClass(FitnessClass):
+    coach_name: Optional[str] = None
+    registered: bool
+
+class Schedule(BaseModel):
+    user_id: int
+    role: str
+    classes: List[ScheduledClass]
 
 # Initialize or read data
-try:
-    coaches = read_json("coaches.json")
-except FileNotFoundError:
-    coaches = []
-    write_json(coaches, "coaches.json")
+db = open_store()
+
+# Resolved users of recently seen tokens; dropped when the user changes
+principal_cache = PrincipalCache()
+db.subscribe(principal_cache.on_change)
+
+# Records cut down to the fields= of recent requests
+projections = ProjectionCache()
+db.subscribe(projections.on_change)
+
+# Tokens revoked by logout and users whose sessions were revoked by an admin
+revocations = RevocationList(db)
+
+# Server-tracked refresh tokens, rotated on every use
+refresh_tokens = RefreshTokens(db)
+
+# RSA keys signing access tokens, shared by all workers
+signing_keys = SigningKeys(db, DEFAULT_TOKEN_EXPIRE_HOURS * 3600)
+
+async def rotate_signing_keys():
+    # Key generation is CPU-heavy, so it runs in the hashing processes
+    active_from = signing_keys.next_activation()
+    if active_from is not None:
+        private_key = await hash_pool.run(generate_private_key)
+        await run_in_threadpool(signing_keys.add, private_key, active_from)
+    await run_in_threadpool(signing_keys.purge)
+
+# Results of POSTs sent with an Idempotency-Key, replayed on retries
+idempotency_keys = IdempotencyKeys(db)
+
+def idempotency_owner(headers):
+    # Keys are per user, so nobody can replay someone else's response
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        try:
+            return "user:" + signing_keys.verify(token)["sub"]
+        except (JWTError, KeyError):
+            pass
+    return "anonymous"
+
+app.add_middleware(
+    IdempotencyMiddleware,
+    keys=idempotency_keys,
+    paths={"/register", "/classes", "/signup"},
+    owner_of=idempotency_owner,
+)
+
+# Set up CORS middleware configuration, added last so it also wraps the
+# responses of the middleware above
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["http://localhost:3000"],  # Allows all origins
+    allow_credentials=True,
+    allow_methods=["*"],  # Allows all methods
+    allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Next-Cursor", "Idempotent-Replayed"],
+)
 
-try:
-    fitness_classes = read_json("fitness_classes.json")
-except FileNotFoundError:
-    fitness_classes = []
-    write_json(fitness_classes, "fitness_classes.json")
 
-try:
-    registrations = read_json("registrations.json")
-except FileNotFoundError:
-    registrations = []
-    write_json(registrations, "registrations.json")
+async def purge_expired_periodically():
+    while True:
+        await asyncio.sleep(300)
+        await run_in_threadpool(revocations.purge)
+        await run_in_threadpool(refresh_tokens.purge)
+        await run_in_threadpool(idempotency_keys.purge)
+        try:
+            await rotate_signing_keys()
+        except HashingBusy:
+            pass
 
+@app.on_event("startup")
+async def start_purging():
+    # Registered after configure_hash_pool, so the pool is ready
+    await rotate_signing_keys()
+    asyncio.create_task(purge_expired_periodically())
 
 
-@app.post("/signup", response_model=User)
-async def create_user(user: UserRegistration):
-    users = read_json("users_db.json")
+async def archive_periodically():
+    while True:
+        await run_in_threadpool(archive_past_classes, db)
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def start_archiving():
+    # Finished classes and their registrations move to the cold archive
+    if ARCHIVE_INTERVAL_SECONDS > 0:
+        asyncio.create_task(archive_periodically())
 
-    # Assign a new user_id
-    if users:  # if there are already users in the db
-        new_user_id = max(user["user_id"] for user in users) + 1
-    else:
-        new_user_id = 1
 
-    if any(u["username"] == user.username for u in users):
+
+# Login and signup attempts, limited before any password hashing happens
+username_limiter = SlidingWindowLimiter(USERNAME_RATE_LIMIT)
+client_limiter = SlidingWindowLimiter(CLIENT_RATE_LIMIT)
+
+def throttle(request: Request, username: str):
+    client = request.client.host if request.client else "unknown"
+    retry_after = max(
+        username_limiter.retry_after(username) or 0,
+        client_limiter.retry_after(client) or 0,
+    )
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many attempts, please retry later",
+            headers={"Retry-After": str(retry_after)},
+        )
+    username_limiter.record(username)
+    client_limiter.record(client)
+
+
+@app.post("/signup", response_model=User)
+async def create_user(user: UserRegistration, request: Request):
+    throttle(request, user.username)
+    if db.find("users", "username", user.username):
         raise HTTPException(status_code=400, detail="Username already exists")
 
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash(user.password)
+
+    # Assign a new user_id
+    new_user_id = await run_in_threadpool(db.next_id, "users")
+
     new_user = {
         "user_id": new_user_id,  # use the new user_id
         "username": user.username,
@@ -144,233 +275,698 @@ async def create_user(user: UserRegistration):
         "disabled": False,
         "role": user.role
     }
-    users.append(new_user)
-    write_json(users, "users_db.json")
+    # The check above saves hashing for taken names; this one is atomic, for
+    # concurrent signups with the same name
+    rejected = await run_in_threadpool(db.insert_many, "users", [new_user], "username")
+    if rejected:
+        raise HTTPException(status_code=400, detail="Username already exists")
     return new_user
 
 
 @app.post("/login", response_model=Token)
-async def login_for_access_token(request_data: UserLoginRequest):
-    users = read_json("users_db.json")
-    user_dict = next((user for user in users if user["username"] == request_data.username), None)
+async def login_for_access_token(request_data: UserLoginRequest, request: Request, background_tasks: BackgroundTasks):
+    throttle(request, request_data.username)
+    users = db.find("users", "username", request_data.username)
+    user_dict = users[0] if users else None
     
     if not user_dict:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
     
-    if not verify_password(request_data.password, user_dict["hashed_password"]):
+    if not await verify_password(request_data.password, user_dict["hashed_password"]):
         raise HTTPException(status_code=400, detail="Incorrect username or password")
+
+    if needs_rehash(user_dict["hashed_password"]):
+        background_tasks.add_task(rehash_password, user_dict["user_id"], request_data.password, user_dict["hashed_password"])
     
+    refresh_token, family_id = await run_in_threadpool(refresh_tokens.issue, user_dict["user_id"])
+    return issue_tokens(user_dict, refresh_token, family_id)
+
+
+def issue_tokens(user_dict, refresh_token, family_id):
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    # sid ties the access token to its refresh token family, for logout
     access_token = create_access_token(
-        data={"sub": user_dict["username"], "role": user_dict["role"]}, expires_delta=access_token_expires
+        data={"sub": user_dict["username"], "role": user_dict["role"], "sid": family_id},
+        expires_delta=access_token_expires,
     )
-    
+
     return {
         "access_token": access_token, 
         "token_type": "bearer",
         "user_id": user_dict["user_id"],
-        "role": user_dict["role"]  # Include the role in the response
+        "role": user_dict["role"],  # Include the role in the response
+        "refresh_token": refresh_token,
     }
 
 
+@app.post("/token/refresh", response_model=Token)
+def refresh_access_token(request_data: RefreshRequest):
+    # Exchanges a refresh token for a new access token and its successor
+    # refresh token, without a password check
+    try:
+        user_id, family_id, refresh_token = refresh_tokens.rotate(request_data.refresh_token)
+    except InvalidRefreshToken:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+        )
+    user_dict = db.get("users", user_id)
+    if user_dict is None:
+        refresh_tokens.revoke_family(family_id)
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+    return issue_tokens(user_dict, refresh_token, family_id)
+
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    # Let changes from other workers invalidate cached principals and reach
+    # the revocation list first
+    db.refresh()
+    cached = principal_cache.get(token)
+    if cached is None:
+        try:
+            payload = signing_keys.verify(token)
+        except JWTError:
+            raise credentials_exception
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
-        users = read_json("users_db.json")
-        user_dict = next((user for user in users if user["username"] == username), None)
+        users = db.find("users", "username", username)
+        user_dict = users[0] if users else None
         if user_dict is None:
             raise credentials_exception
-        return User(**user_dict)
-    except JWTError:
+        # Tokens from before issued_at existed only have iat
+        cached = (User(**user_dict), payload.get("jti"), payload.get("issued_at", payload.get("iat")))
+        principal_cache.put(token, user_dict["user_id"], cached, payload["exp"])
+    principal, jti, issued_at = cached
+    if revocations.is_revoked(jti, principal.user_id, issued_at):
         raise credentials_exception
+    return principal
+
+# Page sizes for the list endpoints
+DEFAULT_PAGE_SIZE = int(os.environ.get("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", "1000"))
+
+def key_of(name, record):
+    key_fields = COLLECTIONS[name][1]
+    if len(key_fields) == 1:
+        return record[key_fields[0]]
+    return tuple(record[field] for field in key_fields)
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+def decode_cursor(name, cursor):
+    # The cursor is the last key of the previous page
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        key = None
+    key_fields = COLLECTIONS[name][1]
+    if len(key_fields) == 1:
+        key = [key]
+    if not isinstance(key, list) or len(key) != len(key_fields) or not all(type(value) is int for value in key):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key[0] if len(key_fields) == 1 else tuple(key)
+
+def paginate(name, response: Response, after: Optional[str], limit: Optional[int], archived=(), where=None, between=None):
+    # Keyset pagination in key order: a page is found by seeking to the
+    # cursor, whatever the collection size. The cursor of the next page, if
+    # there is one, goes in the X-Next-Cursor header. Without limit or after
+    # the whole collection is returned, as before. where and between are
+    # passed on to db.query(); archived records must already match them.
+    filtered = where or between is not None
+    if after is None and limit is None:
+        records = db.query(name, where, between) if filtered else db.all(name)
+        hot_keys = {key_of(name, record) for record in records}
+        return records + [record for record in archived if key_of(name, record) not in hot_keys]
+    limit = limit or DEFAULT_PAGE_SIZE
+    start = decode_cursor(name, after) if after is not None else None
+    if filtered:
+        records = db.query(name, where, between, start, limit + 1)
+    else:
+        records = db.page(name, start, limit + 1)
+    if archived:
+        merged = {
+            key_of(name, record): record
+            for record in archived
+            if start is None or key_of(name, record) > start
+        }
+        merged.update((key_of(name, record), record) for record in records)
+        records = [merged[key] for key in sorted(merged)[:limit + 1]]
+    if len(records) > limit:
+        records = records[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(key_of(name, records[-1]))
+    return records
+
+def not_modified(request: Request, response: Response, *names):
+    # Validators from the versions of the collections behind a response. They
+    # must be read before the data, so a change in between only makes the
+    # ETag older than the body, never newer. Returns the 304 response to send
+    # if the client's copy is current; otherwise sets the headers on response.
+    versions = [db.version(name) for name in names]
+    etag = '"' + "-".join(f"{version}.{round((modified or 0) * 1000)}" for version, modified in versions) + '"'
+    modified = max((modified for _, modified in versions if modified), default=None)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Accept-Encoding"}
+    if modified is not None:
+        headers["Last-Modified"] = formatdate(modified, usegmt=True)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Compressed variants carry their own ETag but are the same version
+        tags = {strip_variant(tag.strip().removeprefix("W/")): tag.strip() for tag in if_none_match.split(",")}
+        current = etag in tags or "*" in tags
+        if etag in tags:
+            headers["ETag"] = tags[etag]
+    else:
+        current = False
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since and modified is not None:
+            try:
+                current = int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                pass
+    if current:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+def parse_fields(name, model, fields: Optional[str]):
+    # fields=a,b selects the fields to return; the key fields always come along
+    if fields is None:
+        return None
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in model.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return tuple(dict.fromkeys(COLLECTIONS[name][1] + tuple(requested)))
+
+def parse_expand(expand: Optional[str], allowed):
+    if expand is None:
+        return ()
+    requested = tuple(dict.fromkeys(item.strip() for item in expand.split(",") if item.strip()))
+    unknown = [item for item in requested if item not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Cannot expand: {', '.join(unknown)}")
+    return requested
+
+def shape(name, records, fields, expand):
+    # Applies fields= and expand= to a list of records. Related records are
+    # looked up once per request.
+    related = {}
+
+    def lookup(collection, key):
+        if (collection, key) not in related:
+            related[(collection, key)] = db.get(collection, key)
+        return related[(collection, key)]
+
+    # Projections can only be cached for records the store keeps as objects
+    cached = db.stable_records(name)
+    shaped = []
+    for record in records:
+        if fields is None:
+            result = record
+        elif cached:
+            result = projections.project(name, key_of(name, record), record, fields)
+        else:
+            result = {field: record.get(field) for field in fields}
+        if expand:
+            result = dict(result)
+            f_class = lookup("fitness_classes", record["class_id"]) if name == "registrations" else record
+            if "class" in expand:
+                result["class"] = f_class
+            if "coach" in expand:
+                result["coach"] = lookup("coaches", f_class["coach_id"]) if f_class else None
+        shaped.append(result)
+    return shaped
+
+# Encoded and compressed bodies of catalog reads, rebuilt after each write
+response_cache = ResponseCache()
+
+def cached_response(request: Request, response: Response):
+    # Call after not_modified(), which sets the ETag the entry must match
+    entry = response_cache.get(request, response.headers["etag"])
+    if entry is None:
+        return None
+    return entry.response(request.headers.get("accept-encoding", ""))
+
+def cache_json_response(request: Request, response: Response, content):
+    headers = {key: value for key, value in response.headers.items() if key != "content-length"}
+    entry = response_cache.put(request, headers["etag"], content, headers)
+    return entry.response(request.headers.get("accept-encoding", ""))
+
+def json_response(response: Response, content):
+    # Records in the store were validated when they were written, so list
+    # responses skip the response model (kept on the routes for the docs) and
+    # are encoded straight to bytes. Headers already set on response are
+    # carried over.
+    headers = {key: value for key, value in response.headers.items() if key != "content-length"}
+    return FastJSONResponse(content=content, headers=headers)
 
 # Endpoints for Coaches
 @app.get("/coaches", response_model=List[Coach])
-async def get_coaches(current_user: User = Depends(get_current_user)):
-    return coaches
-
+async def get_coaches(
+    request: Request,
+    response: Response,
+    after: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+):
+    selected = parse_fields("coaches", Coach, fields)
+    cached = not_modified(request, response, "coaches") or cached_response(request, response)
+    if cached is not None:
+        return cached
+    coaches = paginate("coaches", response, after, limit)
+    if selected is not None:
+        coaches = shape("coaches", coaches, selected, ())
+    return cache_json_response(request, response, coaches)
+
+
+@app.get("/.well-known/jwks.json")
+async def get_jwks():
+    # Public keys for verifying access tokens without calling this service
+    db.refresh()
+    return Response(
+        content=signing_keys.jwks,
+        media_type="application/json",
+        headers={"Cache-Control": f"public, max-age={JWKS_MAX_AGE}"},
+    )
 
 @app.get("/")
 async def root():
     return {"message": "Welcome to the API!"}
 
+@app.post("/logout", response_model=dict)
+def logout(token: str = Depends(oauth2_scheme), current_user: User = Depends(get_current_user)):
+    # The token was verified by get_current_user
+    claims = jwt.get_unverified_claims(token)
+    if claims.get("jti") is None:
+        raise HTTPException(status_code=400, detail="Token cannot be revoked")
+    revocations.revoke(claims["jti"], claims["exp"])
+    if claims.get("sid"):
+        refresh_tokens.revoke_family(claims["sid"])
+    return {"message": "Logged out"}
+
 @app.get("/current_user", response_model=User)
 async def get_current_user_data(current_user: User = Depends(get_current_user)):
     return current_user
 
 @app.post("/coaches", response_model=Coach)
-async def add_coach(coach: Coach, current_user: User = Depends(get_current_user)):
+def add_coach(coach: Coach, current_user: User = Depends(get_current_user)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Access forbidden")
-    if any(c["coach_id"] == coach.coach_id for c in coaches):
+    if not db.insert("coaches", coach.dict()):
         raise HTTPException(status_code=400, detail="Coach with this ID already exists")
-    coaches.append(coach.dict())
-    write_json(coaches, "coaches.json")
     return coach
 
 @app.put("/coaches/{coach_id}", response_model=Coach)
-async def update_coach(coach_id: int, updated_coach: Coach, current_user: User = Depends(get_current_user)):
+def update_coach(coach_id: int, updated_coach: Coach, current_user: User = Depends(get_current_user)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Access forbidden")
-    for idx, c in enumerate(coaches):
-        if c['coach_id'] == coach_id:
-            coaches[idx] = updated_coach.dict()
-            write_json(coaches, "coaches.json")
-            return updated_coach
-    raise HTTPException(status_code=404, detail="Coach not found")
+    if updated_coach.coach_id != coach_id:
+        # Changing the ID moves the coach in one commit, never over another one
+        conflicts, missing = db.apply_batch("coaches", inserts=[updated_coach.dict()], deletes=[coach_id])
+        if missing:
+            raise HTTPException(status_code=404, detail="Coach not found")
+        if conflicts:
+            raise HTTPException(status_code=400, detail="Coach with this ID already exists")
+        return updated_coach
+    if db.get("coaches", coach_id) is None:
+        raise HTTPException(status_code=404, detail="Coach not found")
+    db.put("coaches", updated_coach.dict())
+    return updated_coach
 
 @app.delete("/coaches/{coach_id}", response_model=dict)
-async def delete_coach(coach_id: int, current_user: User = Depends(get_current_user)):
+def delete_coach(coach_id: int, current_user: User = Depends(get_current_user)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Access forbidden")
-    global coaches
-    coaches = [coach for coach in coaches if coach['coach_id'] != coach_id]
-    write_json(coaches, "coaches.json")
+    db.delete("coaches", coach_id)
     return {"message": "Coach deleted"}
 
 # Endpoints for Fitness Classes
+def parse_time(value: Optional[str], name: str):
+    if value is None:
+        return None
+    try:
+        return to_epoch(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name} time")
+
+def class_matches(f_class, where, between):
+    # The filters of db.query(), for archived classes
+    if any(f_class.get(field) != value for field, value in where.items()):
+        return False
+    if between is None:
+        return True
+    _, low, high = between
+    try:
+        start = to_epoch(f_class["start_time"])
+    except ValueError:
+        return False
+    return (low is None or start >= low) and (high is None or start < high)
+
 @app.get("/classes", response_model=List[FitnessClass])
-async def get_classes(current_user: User = Depends(get_current_user)):
-    fitness_classes = read_json("fitness_classes.json")
-    return fitness_classes
+async def get_classes(
+    request: Request,
+    response: Response,
+    include_past: bool = False,
+    start_from: Optional[str] = Query(None, alias="from"),
+    start_to: Optional[str] = Query(None, alias="to"),
+    class_type: Optional[str] = None,
+    coach_id: Optional[int] = None,
+    after: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = None,
+    expand: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+):
+    selected = parse_fields("fitness_classes", FitnessClass, fields)
+    expanded = parse_expand(expand, ("coach",))
+    cached = (
+        not_modified(request, response, "fitness_classes", *(("coaches",) if expanded else ()))
+        or cached_response(request, response)
+    )
+    if cached is not None:
+        return cached
+    # from and to bound start_time (from inclusive, to exclusive)
+    where = {field: value for field, value in (("class_type", class_type), ("coach_id", coach_id)) if value is not None}
+    between = None
+    if start_from is not None or start_to is not None:
+        between = ("start_time", parse_time(start_from, "from"), parse_time(start_to, "to"))
+    archived = []
+    if include_past:
+        archived = [
+            entry["class"] for entry in (await run_in_threadpool(read_archive)).values()
+            if class_matches(entry["class"], where, between)
+        ]
+    fitness_classes = paginate("fitness_classes", response, after, limit, archived, where, between)
+    if selected is not None or expanded:
+        fitness_classes = shape("fitness_classes", fitness_classes, selected, expanded)
+    return cache_json_response(request, response, fitness_classes)
 
 @app.post("/classes", response_model=FitnessClass)
-async def add_class(fitness_class: FitnessClass, current_user: User = Depends(get_current_user)):
+def add_class(fitness_class: FitnessClass, current_user: User = Depends(get_current_user)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Access forbidden")
 
-    fitness_classes = read_json("fitness_classes.json")
-
-    new_class_id = max([f_class["class_id"] for f_class in fitness_classes], default=0) + 1
+    new_class_id = db.next_id("fitness_classes")
     new_class = fitness_class.dict()
     new_class["class_id"] = new_class_id  # Assign a new ID
-    fitness_classes.append(new_class)
 
-    write_json(fitness_classes, "fitness_classes.json")
+    db.put("fitness_classes", new_class)
     return new_class
 
 
 @app.put("/classes/{class_id}", response_model=FitnessClass)
-async def update_class(class_id: int, updated_class: FitnessClass, current_user: User = Depends(get_current_user)):
+def update_class(class_id: int, updated_class: FitnessClass, current_user: User = Depends(get_current_user)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Access forbidden")
 
-    fitness_classes = read_json("fitness_classes.json")  # Reload the latest classes
+    if db.get("fitness_classes", class_id) is None:
+        raise HTTPException(status_code=404, detail="Fitness class not found")
 
-    for idx, f_class in enumerate(fitness_classes):
-        if f_class['class_id'] == class_id:
-            fitness_classes[idx] = updated_class.dict()
-            fitness_classes[idx]["class_id"] = class_id  # Ensure class ID remains unchanged
-            write_json(fitness_classes, "fitness_classes.json")
-            return fitness_classes[idx]
-    raise HTTPException(status_code=404, detail="Fitness class not found")
+    new_class = updated_class.dict()
+    new_class["class_id"] = class_id  # Ensure class ID remains unchanged
+    return db.put("fitness_classes", new_class)
 
 
 @app.delete("/classes/{class_id}", response_model=dict)
-async def delete_class(class_id: int, current_user: User = Depends(get_current_user)):
+def delete_class(class_id: int, current_user: User = Depends(get_current_user)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Access forbidden")
 
-    fitness_classes = read_json("fitness_classes.json")  # Reload the latest classes
-
-    fitness_classes = [f_class for f_class in fitness_classes if f_class['class_id'] != class_id]
-    write_json(fitness_classes, "fitness_classes.json")
+    db.delete("fitness_classes", class_id)
     return {"message": "Fitness class deleted"}
 
 
 # Endpoints for Registrations
 @app.post("/register", response_model=Registration)
-async def register_for_class(registration: Registration, current_user: User = Depends(get_current_user)):
-    # Reload the current registrations
-    registrations = read_json("registrations.json")
-
-    if not any(f_class for f_class in fitness_classes if f_class["class_id"] == registration.class_id):
+def register_for_class(registration: Registration, current_user: User = Depends(get_current_user)):
+    if db.get("fitness_classes", registration.class_id) is None:
         raise HTTPException(status_code=404, detail="Fitness class not found")
 
-    if any(reg for reg in registrations if reg["user_id"] == registration.user_id and reg["class_id"] == registration.class_id):
+    if not db.insert("registrations", registration.dict()):
         raise HTTPException(status_code=400, detail="User already registered for this class")
     
-    registrations.append(registration.dict())
-    write_json(registrations, "registrations.json")
-    
     return registration
 
 
-@app.get("/registrations", response_model=List[Registration])
-async def get_user_registrations(current_user: User = Depends(get_current_user)):
-    # Reload the registrations from the JSON file
-    registrations = read_json("registrations.json")
+# Registers the current user for, and cancels, several classes at once. Every
+# item is checked first; if any fails nothing is changed, otherwise the whole
+# set is applied in one atomic commit.
+@app.post("/registrations/batch", response_model=dict)
+def register_batch(batch: RegistrationBatch, current_user: User = Depends(get_current_user)):
+    user_id = current_user.user_id
+    items = [("register", class_id) for class_id in batch.register_ids] + [("cancel", class_id) for class_id in batch.cancel]
+    results = []
+    seen = set()
+    for action, class_id in items:
+        error = None
+        if class_id in seen:
+            error = "Duplicate class in batch"
+        elif action == "register" and db.get("fitness_classes", class_id) is None:
+            error = "Fitness class not found"
+        elif action == "register" and db.get("registrations", (user_id, class_id)) is not None:
+            error = "User already registered for this class"
+        elif action == "cancel" and db.get("registrations", (user_id, class_id)) is None:
+            error = "User is not registered for this class"
+        seen.add(class_id)
+        results.append({"class_id": class_id, "action": action, "status": "error" if error else "ok", "error": error})
+
+    if not any(result["error"] for result in results):
+        # Re-checked under the store's lock, in case another request got in between
+        conflicts, missing = db.apply_batch(
+            "registrations",
+            inserts=[{"user_id": user_id, "class_id": class_id} for class_id in batch.register_ids],
+            deletes=[(user_id, class_id) for class_id in batch.cancel],
+        )
+        failed = {record["class_id"]: "User already registered for this class" for record in conflicts}
+        failed.update((key[1], "User is not registered for this class") for key in missing)
+        for result in results:
+            if result["class_id"] in failed:
+                result.update(status="error", error=failed[result["class_id"]])
+
+    if any(result["error"] for result in results):
+        for result in results:
+            if result["status"] == "ok":
+                result["status"] = "skipped"
+        raise HTTPException(status_code=400, detail={"message": "No changes were applied", "results": results})
+    return {"results": results}
+
+# Everything the classes page needs in one call: upcoming classes in start
+# order, with their coach's name and whether the caller is registered
+@app.get("/schedule", response_model=Schedule)
+async def get_schedule(
+    start_from: Optional[str] = Query(None, alias="from"),
+    start_to: Optional[str] = Query(None, alias="to"),
+    current_user: User = Depends(get_current_user),
+):
+    low = parse_time(start_from, "from")
+    between = ("start_time", time.time() if low is None else low, parse_time(start_to, "to"))
+    upcoming = db.query("fitness_classes", between=between)
+    registered = {reg["class_id"] for reg in db.find("registrations", "user_id", current_user.user_id)}
+    coach_names = {}
+    for coach_id in {f_class["coach_id"] for f_class in upcoming}:
+        coach = db.get("coaches", coach_id)
+        coach_names[coach_id] = f"{coach['first_name']} {coach['last_name']}" if coach else None
+    classes = [
+        dict(f_class, coach_name=coach_names[f_class["coach_id"]], registered=f_class["class_id"] in registered)
+        for f_class in sorted(upcoming, key=lambda f_class: to_epoch(f_class["start_time"]))
+    ]
+    return FastJSONResponse({"user_id": current_user.user_id, "role": current_user.role, "classes": classes})
 
+@app.get("/registrations", response_model=List[Registration])
+async def get_user_registrations(
+    response: Response,
+    include_past: bool = False,
+    fields: Optional[str] = None,
+    expand: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+):
+    selected = parse_fields("registrations", Registration, fields)
+    expanded = parse_expand(expand, ("class", "coach"))
     user_id = current_user.user_id
-    user_registrations = [reg for reg in registrations if reg["user_id"] == user_id]
-    return user_registrations
+    user_registrations = db.find("registrations", "user_id", user_id)
+    if include_past:
+        archived = await run_in_threadpool(read_archive)
+        user_registrations += [
+            reg for entry in archived.values() for reg in entry["registrations"] if reg["user_id"] == user_id
+        ]
+    if selected is not None or expanded:
+        user_registrations = shape("registrations", user_registrations, selected, expanded)
+    return json_response(response, user_registrations)
 
 @app.get("/all-registrations", response_model=List[Registration])
-async def get_user_registrations(current_user: User = Depends(get_current_user)):
+async def get_user_registrations(
+    response: Response,
+    include_past: bool = False,
+    after: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = None,
+    expand: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Access forbidden")
-    # Reload the registrations from the JSON file
-    registrations = read_json("registrations.json")
-
-    return registrations
+    selected = parse_fields("registrations", Registration, fields)
+    expanded = parse_expand(expand, ("class", "coach"))
+    archived = []
+    if include_past:
+        archived = [reg for entry in (await run_in_threadpool(read_archive)).values() for reg in entry["registrations"]]
+    registrations = paginate("registrations", response, after, limit, archived)
+    if selected is not None or expanded:
+        registrations = shape("registrations", registrations, selected, expanded)
+    return json_response(response, registrations)
 
 @app.delete("/cancel_registration/{class_id}", response_model=dict)
-async def cancel_registration(class_id: int, current_user: User = Depends(get_current_user)):
-    # Reload the current registrations
-    registrations = read_json("registrations.json")
-
+def cancel_registration(class_id: int, current_user: User = Depends(get_current_user)):
     # Remove the specific registration
-    registrations = [reg for reg in registrations if not (reg["user_id"] == current_user.user_id and reg["class_id"] == class_id)]
-    
-    write_json(registrations, "registrations.json")
+    db.delete("registrations", (current_user.user_id, class_id))
 
     return {"detail": "Registration cancelled successfully"}
 
+# Largest batch POST /signup/bulk accepts
+BULK_SIGNUP_LIMIT = int(os.environ.get("BULK_SIGNUP_LIMIT", "10000"))
+
+def parse_bulk_users(body: bytes, content_type: str):
+    # A JSON array, or NDJSON with one user per line; unparsable NDJSON lines
+    # come back as None so they can be reported by position
+    if "ndjson" in content_type:
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+        return items
+    try:
+        items = json.loads(body)
+    except ValueError:
+        items = None
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array or NDJSON")
+    return items
+
+# Compiled once; bulk rows are untrusted input
+user_registration_adapter = TypeAdapter(UserRegistration)
+
+def validate_bulk_users(items):
+    # Returns the rows worth hashing as (index, UserRegistration) and the
+    # per-row errors of the rest
+    valid, errors = [], []
+    usernames = set()
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({"index": index, "error": "Expected a JSON object"})
+            continue
+        try:
+            user = user_registration_adapter.validate_python(item)
+        except ValidationError as exc:
+            problems = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in exc.errors())
+            errors.append({"index": index, "error": problems})
+            continue
+        if user.username in usernames:
+            errors.append({"index": index, "error": "Duplicate username in batch"})
+        elif db.find("users", "username", user.username):
+            errors.append({"index": index, "error": "Username already exists"})
+        else:
+            usernames.add(user.username)
+            valid.append((index, user))
+    return valid, errors
+
+@app.post("/signup/bulk", response_model=dict)
+async def create_users_bulk(request: Request, current_user: User = Depends(get_current_user)):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Access forbidden")
+    items = parse_bulk_users(await request.body(), request.headers.get("content-type", ""))
+    if len(items) > BULK_SIGNUP_LIMIT:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_SIGNUP_LIMIT} users per request")
+
+    valid, errors = await run_in_threadpool(validate_bulk_users, items)
+    created = []
+    if valid:
+        hashed_passwords = await get_password_hashes([user.password for _, user in valid])
+        first_id = await run_in_threadpool(db.next_id, "users", len(valid))
+        new_users = [
+            {
+                "user_id": first_id + offset,
+                "username": user.username,
+                "hashed_password": hashed_password,
+                "disabled": False,
+                "role": user.role,
+            }
+            for offset, ((_, user), hashed_password) in enumerate(zip(valid, hashed_passwords))
+        ]
+        # One transaction; usernames taken since validation are left out
+        rejected = await run_in_threadpool(db.insert_many, "users", new_users, "username")
+        taken = {record["username"] for record in rejected}
+        for (index, user), new_user in zip(valid, new_users):
+            if user.username in taken:
+                errors.append({"index": index, "error": "Username already exists"})
+            else:
+                created.append({"index": index, "user_id": new_user["user_id"], "username": user.username})
+        errors.sort(key=lambda error: error["index"])
+    return {"created": created, "errors": errors}
+
 # Endpoint to fetch all users
 @app.get("/users", response_model=List[User])
-async def get_all_users(current_user: User = Depends(get_current_user)):
+async def get_all_users(
+    response: Response,
+    after: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    current_user: User = Depends(get_current_user),
+):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Access forbidden")
-    users = read_json("users_db.json")
-    return users
+    return json_response(response, paginate("users", response, after, limit))
 
 # Endpoint to update a user
 @app.put("/users/{user_id}", response_model=User)
 async def update_user(user_id: int, user_update: UserRegistration, current_user: User = Depends(get_current_user)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Access forbidden")
-    users = read_json("users_db.json")
-    user = next((u for u in users if u["user_id"] == user_id), None)
+    user = db.get("users", user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
     # Update user details
+    user = dict(user)
     user["username"] = user_update.username
-    user["hashed_password"] = get_password_hash(user_update.password) if user_update.password else user["hashed_password"]
+    user["hashed_password"] = await get_password_hash(user_update.password) if user_update.password else user["hashed_password"]
     user["role"] = user_update.role
 
-    write_json(users, "users_db.json")
+    if not await run_in_threadpool(db.update, "users", user, "username"):
+        if db.get("users", user_id) is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        raise HTTPException(status_code=400, detail="Username already exists")
     return user
 
+# Endpoint to revoke every token issued to a user so far
+@app.post("/users/{user_id}/revoke-sessions", response_model=dict)
+def revoke_user_sessions(user_id: int, current_user: User = Depends(get_current_user)):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Access forbidden")
+    if db.get("users", user_id) is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    revocations.revoke_user(user_id, DEFAULT_TOKEN_EXPIRE_HOURS * 3600)
+    refresh_tokens.revoke_user(user_id)
+    return {"message": "Sessions revoked"}
+
 # Endpoint to delete a user
 @app.delete("/users/{user_id}", response_model=dict)
-async def delete_user(user_id: int, current_user: User = Depends(get_current_user)):
+def delete_user(user_id: int, current_user: User = Depends(get_current_user)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Access forbidden")
-    users = read_json("users_db.json")
-    if not any(u["user_id"] == user_id for u in users):
+    if not db.delete("users", user_id):
         raise HTTPException(status_code=404, detail="User not found")
-
-    updated_users = [u for u in users if u["user_id"] != user_id]
-    write_json(updated_users, "users_db.json")
+    refresh_tokens.revoke_user(user_id)
     return {"message": "User deleted successfully"}
 
 
@@ -0,0 +1,164 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.context import CryptContext
+from passlib.hash import bcrypt
+
+
+# Processes doing bcrypt work, and how many hash/verify calls may be queued or
+# running before new ones are turned away
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", os.cpu_count() or 1))
+HASH_QUEUE_LIMIT = int(os.environ.get("HASH_QUEUE_LIMIT", str(HASH_WORKERS * 4)))
+
+# bcrypt cost: BCRYPT_ROUNDS pins it, otherwise it is calibrated once so one
+# hash takes about BCRYPT_TARGET_MS, and stored for every worker to use
+BCRYPT_ROUNDS = os.environ.get("BCRYPT_ROUNDS")
+BCRYPT_TARGET_MS = float(os.environ.get("BCRYPT_TARGET_MS", "250"))
+BCRYPT_MIN_ROUNDS = int(os.environ.get("BCRYPT_MIN_ROUNDS", "10"))
+BCRYPT_MAX_ROUNDS = int(os.environ.get("BCRYPT_MAX_ROUNDS", "16"))
+
+# Passwords hashed per pool call when hashing in bulk
+BULK_HASH_CHUNK = int(os.environ.get("BULK_HASH_CHUNK", "16"))
+
+
+def make_context(rounds=None):
+    if rounds is None:
+        return CryptContext(schemes=["bcrypt"], deprecated="auto")
+    # needs_update() flags hashes below the chosen cost; stronger ones are
+    # left as they are
+    return CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__default_rounds=rounds,
+        bcrypt__min_rounds=rounds,
+    )
+
+# Password hashing context
+pwd_context = make_context()
+
+
+def calibrate_rounds(target_ms=BCRYPT_TARGET_MS, minimum=BCRYPT_MIN_ROUNDS, maximum=BCRYPT_MAX_ROUNDS):
+    # Each extra round doubles the work, so time the cheapest allowed cost
+    # and double up to the budget
+    timings = []
+    for _ in range(3):
+        start = time.perf_counter()
+        bcrypt.using(rounds=minimum).hash("calibration")
+        timings.append((time.perf_counter() - start) * 1000)
+    elapsed = min(timings)
+    rounds = minimum
+    while rounds < maximum and elapsed * 2 <= target_ms:
+        rounds += 1
+        elapsed *= 2
+    return rounds
+
+
+# Run inside the pool processes
+def _configure(rounds):
+    global pwd_context
+    pwd_context = make_context(rounds)
+
+def _hash(password):
+    return pwd_context.hash(password)
+
+def _hash_many(passwords):
+    return [pwd_context.hash(password) for password in passwords]
+
+def _verify(plain_password, hashed_password):
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class HashPool:
+    # bcrypt is CPU-bound and holds the GIL, so it runs in separate processes
+    # and never on the event loop. The number of outstanding calls is capped so
+    # a burst of logins is rejected quickly instead of queueing for seconds.
+    def __init__(self, workers=HASH_WORKERS, queue_limit=HASH_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.executor = None
+        self.rounds = None
+
+    def configure(self, rounds):
+        # Sets the bcrypt cost here and in the pool processes
+        _configure(rounds)
+        self.shutdown()
+        with self.lock:
+            self.rounds = rounds
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                # spawn keeps the children free of the server's threads and state
+                self.executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_configure,
+                    initargs=(self.rounds,),
+                )
+            return self.executor
+
+    async def run(self, function, *args):
+        with self.lock:
+            if self.pending >= self.queue_limit:
+                raise HashingBusy()
+            self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor(), function, *args)
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+
+hash_pool = HashPool()
+
+async def verify_password(plain_password, hashed_password):
+    return await hash_pool.run(_verify, plain_password, hashed_password)
+
+async def get_password_hash(password):
+    return await hash_pool.run(_hash, password)
+
+async def get_password_hashes(passwords):
+    # Small chunks, at most one per worker at a time: the batch uses every
+    # core while single logins still find a free worker between chunks
+    semaphore = asyncio.Semaphore(hash_pool.workers)
+
+    async def hash_chunk(chunk):
+        async with semaphore:
+            return await hash_pool.run(_hash_many, chunk)
+
+    chunks = [passwords[i:i + BULK_HASH_CHUNK] for i in range(0, len(passwords), BULK_HASH_CHUNK)]
+    results = await asyncio.gather(*(hash_chunk(chunk) for chunk in chunks))
+    return [hashed for chunk in results for hashed in chunk]
+
+def needs_rehash(hashed_password):
+    # Cheap: only parses the hash, no bcrypt work
+    return pwd_context.needs_update(hashed_password)
+
+def configured_rounds(store):
+    # The first worker to start calibrates and stores the cost; every other
+    # worker, and every restart, uses the stored one. Timings differ between
+    # processes, and a cost picked per worker would make them rehash each
+    # other's hashes back and forth.
+    if BCRYPT_ROUNDS:
+        return int(BCRYPT_ROUNDS)
+    setting = store.get("settings", "bcrypt_rounds")
+    if setting is None:
+        store.insert("settings", {"name": "bcrypt_rounds", "value": calibrate_rounds()})
+        setting = store.get("settings", "bcrypt_rounds")
+    return setting["value"]
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import time
+
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response
+from starlette.datastructures import Headers
+
+
+# How long a completed request can be replayed, and how long a request that
+# is still running (or whose worker died) holds its key
+IDEMPOTENCY_TTL_SECONDS = float(os.environ.get("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_PENDING_SECONDS = float(os.environ.get("IDEMPOTENCY_PENDING_SECONDS", "60"))
+# Keys kept after each purge; the ones expiring soonest go first
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get("IDEMPOTENCY_MAX_KEYS", "100000"))
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyInProgress(Exception):
+    pass
+
+
+class IdempotencyMismatch(Exception):
+    pass
+
+
+class IdempotencyKeys:
+    # Results of requests sent with an Idempotency-Key, in the store's
+    # "idempotency_keys" collection so a retry that lands on another worker is
+    # still recognised. Keys are scoped to their owner and bound to a
+    # fingerprint of the request they were first used with. Inserting the
+    # pending record is the lock: only one request per key gets to run.
+    def __init__(self, store, ttl=IDEMPOTENCY_TTL_SECONDS, pending_ttl=IDEMPOTENCY_PENDING_SECONDS, max_keys=IDEMPOTENCY_MAX_KEYS):
+        self.store = store
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self.max_keys = max_keys
+
+    @staticmethod
+    def _hash(owner, key):
+        return hashlib.sha256(f"{owner}\n{key}".encode()).hexdigest()
+
+    def begin(self, owner, key, fingerprint):
+        # Returns the stored result to replay, or None if the caller should run
+        # the request (and then call complete() or abandon())
+        key_hash = self._hash(owner, key)
+        now = time.time()
+        pending = {
+            "key_hash": key_hash,
+            "fingerprint": fingerprint,
+            "status_code": 0,
+            "headers": "[]",
+            "body": "",
+            "expires_at": now + self.pending_ttl,
+        }
+        if self.store.insert("idempotency_keys", pending):
+            return None
+        record = self.store.get("idempotency_keys", key_hash)
+        if record is None or record["expires_at"] <= now:
+            # Abandoned or expired in the meantime
+            if record is not None:
+                self.store.delete("idempotency_keys", key_hash)
+            if self.store.insert("idempotency_keys", pending):
+                return None
+            raise IdempotencyInProgress()
+        if record["fingerprint"] != fingerprint:
+            raise IdempotencyMismatch()
+        if record["status_code"] == 0:
+            raise IdempotencyInProgress()
+        return record
+
+    def complete(self, owner, key, fingerprint, status_code, headers, body):
+        self.store.put("idempotency_keys", {
+            "key_hash": self._hash(owner, key),
+            "fingerprint": fingerprint,
+            "status_code": status_code,
+            "headers": json.dumps(headers),
+            "body": body,
+            "expires_at": time.time() + self.ttl,
+        })
+
+    def abandon(self, owner, key):
+        self.store.delete("idempotency_keys", self._hash(owner, key))
+
+    def purge(self):
+        now = time.time()
+        live = []
+        for record in self.store.all("idempotency_keys"):
+            if record["expires_at"] <= now:
+                self.store.delete("idempotency_keys", record["key_hash"])
+            else:
+                live.append(record)
+        if len(live) > self.max_keys:
+            live.sort(key=lambda record: record["expires_at"])
+            for record in live[:len(live) - self.max_keys]:
+                self.store.delete("idempotency_keys", record["key_hash"])
+
+
+class IdempotencyMiddleware:
+    # A POST to one of paths carrying an Idempotency-Key runs once; retries
+    # with the same key get the stored response back without redoing the
+    # work. Only successful (2xx) responses are kept, so a failed request can
+    # be retried for real. The response is recorded before it is sent, so any
+    # retry that follows it finds it.
+    def __init__(self, app, keys, paths, owner_of):
+        self.app = app
+        self.keys = keys
+        self.paths = paths
+        # owner_of(headers) names whose keys these are
+        self.owner_of = owner_of
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        headers = Headers(scope=scope)
+        key = headers.get("idempotency-key")
+        if key is None:
+            return await self.app(scope, receive, send)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            response = JSONResponse({"detail": "Invalid Idempotency-Key"}, status_code=400)
+            return await response(scope, receive, send)
+
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        body = b"".join(chunks)
+        fingerprint = hashlib.sha256(b"\n".join([scope["path"].encode(), scope["query_string"], body])).hexdigest()
+        owner = self.owner_of(headers)
+
+        try:
+            stored = await run_in_threadpool(self.keys.begin, owner, key, fingerprint)
+        except IdempotencyInProgress:
+            response = JSONResponse(
+                {"detail": "A request with this Idempotency-Key is in progress"},
+                status_code=409,
+                headers={"Retry-After": "1"},
+            )
+            return await response(scope, receive, send)
+        except IdempotencyMismatch:
+            response = JSONResponse(
+                {"detail": "Idempotency-Key was already used for a different request"},
+                status_code=422,
+            )
+            return await response(scope, receive, send)
+        if stored is not None:
+            response = Response(content=stored["body"], status_code=stored["status_code"])
+            response.raw_headers = [
+                (name.encode("latin-1"), value.encode("latin-1")) for name, value in json.loads(stored["headers"])
+            ] + [(b"idempotent-replayed", b"true")]
+            return await response(scope, receive, send)
+
+        body_sent = False
+
+        async def replay_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        start = None
+        response_chunks = []
+
+        async def capture_send(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+            response_chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            response_body = b"".join(response_chunks)
+            if 200 <= start["status"] < 300:
+                stored_headers = [
+                    (name.decode("latin-1"), value.decode("latin-1")) for name, value in start["headers"]
+                ]
+                await run_in_threadpool(
+                    self.keys.complete, owner, key, fingerprint, start["status"], stored_headers, response_body.decode()
+                )
+            else:
+                await run_in_threadpool(self.keys.abandon, owner, key)
+            await send(start)
+            await send({"type": "http.response.body", "body": response_body, "more_body": False})
+
+        try:
+            await self.app(scope, replay_receive, capture_send)
+        except Exception:
+            await run_in_threadpool(self.keys.abandon, owner, key)
+            raise
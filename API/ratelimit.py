@@ -0,0 +1,62 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+# Allowed attempts per window on /login and /signup
+USERNAME_RATE_LIMIT = int(os.environ.get("USERNAME_RATE_LIMIT", "10"))
+CLIENT_RATE_LIMIT = int(os.environ.get("CLIENT_RATE_LIMIT", "30"))
+RATE_LIMIT_WINDOW_SECONDS = float(os.environ.get("RATE_LIMIT_WINDOW_SECONDS", "60"))
+# Keys tracked per limiter; the least recently seen are evicted beyond this
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "100000"))
+
+
+class SlidingWindowLimiter:
+    # Sliding-window counter: each key keeps the counts of the current and the
+    # previous fixed window, and the rate is the current count plus the
+    # previous one weighted by how much of it still overlaps the sliding
+    # window. Constant memory per key; keys live in an LRU so idle ones are
+    # evicted first.
+    def __init__(self, limit, window=RATE_LIMIT_WINDOW_SECONDS, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.counters = OrderedDict()  # key -> [window start, current count, previous count]
+
+    def _counter(self, key, now):
+        start = now - now % self.window
+        counter = self.counters.get(key)
+        if counter is None or counter[0] < start - self.window:
+            counter = [start, 0, 0]
+        elif counter[0] < start:
+            counter = [start, 0, counter[1]]
+        return counter
+
+    def retry_after(self, key, now=None):
+        # Seconds until key may try again, or None if it may try now
+        now = time.time() if now is None else now
+        with self.lock:
+            start, current, previous = self._counter(key, now)
+        elapsed = now - start
+        if current + previous * (1 - elapsed / self.window) < self.limit:
+            return None
+        if current >= self.limit or not previous:
+            # Nothing left to decay in this window
+            return max(1, math.ceil(self.window - elapsed))
+        # The previous window's weight drops below the remaining allowance at
+        # elapsed = window * (previous - limit + current) / previous, divided
+        # last so whole-second answers do not round up a second
+        return max(1, math.ceil(self.window * (previous - self.limit + current) / previous - elapsed))
+
+    def record(self, key, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            counter = self._counter(key, now)
+            counter[1] += 1
+            self.counters[key] = counter
+            self.counters.move_to_end(key)
+            while len(self.counters) > self.max_keys:
+                self.counters.popitem(last=False)
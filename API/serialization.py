@@ -0,0 +1,136 @@
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:  # falls back to the standard library encoder
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+
+# Encoded responses kept by ResponseCache
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "64"))
+# Bodies smaller than this are always sent uncompressed
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "512"))
+
+
+def dumps(data):
+    # JSON-encodes to bytes
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(Response):
+    # Encodes trusted data straight to bytes, with no validation or
+    # jsonable_encoder pass
+    media_type = "application/json"
+
+    def render(self, content):
+        return dumps(content)
+
+
+def negotiate(accept_encoding):
+    # Picks br, then gzip, from an Accept-Encoding header; None means identity
+    accepted = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    for coding in ("br", "gzip"):
+        if coding == "br" and brotli is None:
+            continue
+        if accepted.get(coding, accepted.get("*", 0.0)) > 0:
+            return coding
+    return None
+
+def compress(body, coding):
+    # Bodies are compressed once per write and sent many times, so spend the
+    # CPU on a high level
+    if coding == "br":
+        return brotli.compress(body, quality=9)
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+def variant_etag(etag, coding):
+    # Each encoding is a different representation, so it needs its own strong ETag
+    return etag if coding is None else f'{etag[:-1]}-{coding}"'
+
+def strip_variant(etag):
+    for coding in ("br", "gzip"):
+        suffix = f'-{coding}"'
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+
+class CachedBody:
+    def __init__(self, etag, body, headers):
+        self.etag = etag
+        self.headers = headers
+        self.variants = {None: body}
+
+    def encoded(self, coding):
+        # Compressed variants are made when first asked for; two requests
+        # racing here just both compress
+        variant = self.variants.get(coding)
+        if variant is None:
+            variant = self.variants[coding] = compress(self.variants[None], coding)
+        return variant
+
+    def response(self, accept_encoding):
+        coding = negotiate(accept_encoding) if len(self.variants[None]) >= COMPRESS_MIN_BYTES else None
+        # Header names are lower case, as Starlette hands them out
+        headers = dict(self.headers, vary="Accept-Encoding")
+        if coding is not None:
+            headers["content-encoding"] = coding
+            headers["etag"] = variant_etag(self.etag, coding)
+        return Response(content=self.encoded(coding), media_type="application/json", headers=headers)
+
+
+class ResponseCache:
+    # Final encoded bodies of read-mostly GETs, keyed by path and query and
+    # valid for one ETag, i.e. until the next write to the data behind them.
+    # The first request after a write rebuilds the body; the others get bytes
+    # that are already encoded and compressed.
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (path, query) -> CachedBody
+
+    @staticmethod
+    def _key(request):
+        return request.url.path, tuple(sorted(request.query_params.multi_items()))
+
+    def get(self, request, etag):
+        key = self._key(request)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.etag != etag:
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, request, etag, content, headers):
+        entry = CachedBody(etag, dumps(content), headers)
+        with self.lock:
+            self.entries[self._key(request)] = entry
+            self.entries.move_to_end(self._key(request))
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return entry
@@ -0,0 +1,442 @@
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+
+from storage import COLLECTIONS, DURABILITY, MemoryStore, same_records, to_epoch
+
+
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "coaching.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS coaches (
+    coach_id INTEGER PRIMARY KEY,
+    first_name TEXT NOT NULL,
+    last_name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    phone_number TEXT NOT NULL,
+    experience_years INTEGER NOT NULL,
+    hourly_rate_idr INTEGER NOT NULL,
+    availability TEXT NOT NULL,
+    bio TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fitness_classes (
+    class_id INTEGER PRIMARY KEY,
+    coach_id INTEGER NOT NULL,
+    start_time TEXT NOT NULL,
+    end_time TEXT NOT NULL,
+    class_type TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fitness_classes_start_time ON fitness_classes (start_time);
+CREATE INDEX IF NOT EXISTS fitness_classes_start_epoch ON fitness_classes (epoch(start_time));
+CREATE INDEX IF NOT EXISTS fitness_classes_class_type ON fitness_classes (class_type);
+CREATE INDEX IF NOT EXISTS fitness_classes_coach_id ON fitness_classes (coach_id);
+CREATE TABLE IF NOT EXISTS registrations (
+    user_id INTEGER NOT NULL,
+    class_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, class_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS registrations_class_id ON registrations (class_id);
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    hashed_password TEXT NOT NULL,
+    disabled INTEGER NOT NULL DEFAULT 0,
+    role TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS users_username ON users (username);
+CREATE TABLE IF NOT EXISTS revocations (
+    jti TEXT PRIMARY KEY,
+    user_id INTEGER,
+    not_before REAL,
+    expires_at REAL NOT NULL
+);
+-- Held one row per refresh token before refresh_families
+DROP TABLE IF EXISTS refresh_tokens;
+CREATE TABLE IF NOT EXISTS refresh_families (
+    family_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    token_hash TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS refresh_families_user_id ON refresh_families (user_id);
+CREATE TABLE IF NOT EXISTS signing_keys (
+    kid TEXT PRIMARY KEY,
+    private_key TEXT NOT NULL,
+    active_from REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value NOT NULL
+);
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key_hash TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    status_code INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    body TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sequences (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    modified REAL
+);
+"""
+
+# Every change to a collection bumps its row in versions, whichever
+# connection makes it
+VERSION_TRIGGERS = "".join(
+    f"CREATE TRIGGER IF NOT EXISTS {name}_{event.lower()}_version AFTER {event} ON {name} BEGIN "
+    f"UPDATE versions SET version = version + 1, modified = (julianday('now') - 2440587.5) * 86400 "
+    f"WHERE name = '{name}'; END;\n"
+    for name in COLLECTIONS
+    for event in ("INSERT", "UPDATE", "DELETE")
+)
+
+# PRAGMA synchronous value for each durability level
+SYNCHRONOUS = {"none": "OFF", "flush": "NORMAL", "fsync": "FULL"}
+
+# Columns SQLite cannot round-trip on its own
+CONVERTERS = {
+    "users": {"disabled": bool},
+}
+
+
+def sql_epoch(timestamp):
+    # epoch() in SQL; the index on it stores the value parsed when the row
+    # was written
+    try:
+        return to_epoch(timestamp)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class SqliteStore:
+    # Same interface as MemoryStore, backed by a SQLite database in WAL mode so
+    # several worker processes can share it. SQLite commits each transaction
+    # itself, so the durability level is applied per connection.
+    def __init__(self, path=SQLITE_PATH, durability=DURABILITY):
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA synchronous={SYNCHRONOUS[durability]}")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        # Must exist on every connection that writes fitness_classes
+        self.conn.create_function("epoch", 1, sql_epoch, deterministic=True)
+        self.conn.executescript(SCHEMA)
+        self.conn.executescript(VERSION_TRIGGERS)
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO versions (name, version) VALUES (?, 0)",
+            ((name,) for name in COLLECTIONS),
+        )
+        self.columns = {
+            name: [row[1] for row in self.conn.execute(f"PRAGMA table_info({name})")]
+            for name in COLLECTIONS
+        }
+        self.listeners = []
+        # Cached rows of the versions table, dropped on every change
+        self.versions = {}
+        # Version of every collection as of the last change this connection
+        # knows about, to tell which ones other workers changed
+        self.seen = self._read_versions()
+        self.data_version = self._data_version()
+
+    def _data_version(self):
+        # Changes whenever another connection commits to the database
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _read_versions(self):
+        return dict(self.conn.execute("SELECT name, version FROM versions"))
+
+    def _refresh(self):
+        data_version = self._data_version()
+        if data_version != self.data_version:
+            self.data_version = data_version
+            self._sync()
+
+    def _sync(self):
+        # Another worker wrote something. The record-level changes are not
+        # known, so the collections whose version moved count as reset.
+        versions = self._read_versions()
+        changed = [name for name in COLLECTIONS if versions.get(name) != self.seen.get(name)]
+        self.seen = versions
+        for name in changed:
+            self._changed(name, "reset", None)
+
+    @contextmanager
+    def _write(self, *names):
+        # One immediate transaction. Other workers' commits are picked up
+        # first, while nobody else can write, so the versions read back at the
+        # end count only this change on top of what we have seen.
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                self._sync()
+                yield
+                for name in names:
+                    (self.seen[name],) = self.conn.execute(
+                        "SELECT version FROM versions WHERE name = ?", (name,)
+                    ).fetchone()
+
+    def _changed(self, name, op, payload):
+        self.versions.pop(name, None)
+        for listener in self.listeners:
+            listener(name, op, payload)
+
+    def refresh(self):
+        with self.lock:
+            self._refresh()
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def stable_records(self, name):
+        # Rows are turned into new dicts on every read
+        return False
+
+    def version(self, name):
+        with self.lock:
+            self._refresh()
+            if name not in self.versions:
+                self.versions[name] = self.conn.execute(
+                    "SELECT version, modified FROM versions WHERE name = ?", (name,)
+                ).fetchone()
+            return self.versions[name]
+
+    def _row(self, name, row):
+        record = dict(zip(self.columns[name], row))
+        for field, convert in CONVERTERS.get(name, {}).items():
+            record[field] = convert(record[field])
+        return record
+
+    def _key_clause(self, name, key):
+        key_fields = COLLECTIONS[name][1]
+        values = key if len(key_fields) > 1 else (key,)
+        return " AND ".join(f"{field} = ?" for field in key_fields), tuple(values)
+
+    def _select(self, name, where="", params=()):
+        with self.lock:
+            rows = self.conn.execute(f"SELECT * FROM {name} {where}", params).fetchall()
+        return [self._row(name, row) for row in rows]
+
+    def all(self, name):
+        return self._select(name)
+
+    def get(self, name, key):
+        clause, params = self._key_clause(name, key)
+        records = self._select(name, f"WHERE {clause}", params)
+        return records[0] if records else None
+
+    def _check_field(self, name, field):
+        if field not in self.columns[name]:
+            raise ValueError(f"Unknown field {field!r} for {name}")
+
+    def find(self, name, field, value):
+        self._check_field(name, field)
+        return self._select(name, f"WHERE {field} = ?", (value,))
+
+    def page(self, name, after=None, limit=100):
+        return self.query(name, after=after, limit=limit)
+
+    def query(self, name, where=None, between=None, after=None, limit=None):
+        clauses, params = [], []
+        for field, value in (where or {}).items():
+            self._check_field(name, field)
+            clauses.append(f"{field} = ?")
+            params.append(value)
+        if between is not None:
+            # Matches the expression index on epoch(start_time)
+            field, low, high = between
+            self._check_field(name, field)
+            clauses.append(f"epoch({field}) IS NOT NULL")
+            if low is not None:
+                clauses.append(f"epoch({field}) >= ?")
+                params.append(low)
+            if high is not None:
+                clauses.append(f"epoch({field}) < ?")
+                params.append(high)
+        key_fields = COLLECTIONS[name][1]
+        columns = ", ".join(key_fields)
+        if after is not None:
+            # Row-value comparison walks the primary key index from the cursor
+            clauses.append(f"({columns}) > ({', '.join('?' for _ in key_fields)})")
+            params.extend(after if len(key_fields) > 1 else (after,))
+        sql = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        sql += f" ORDER BY {columns}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self._select(name, sql, tuple(params))
+
+    def next_id(self, name, count=1, durability=None):
+        key_field = COLLECTIONS[name][1][0]
+        # BEGIN IMMEDIATE takes the write lock, so two workers never hand out
+        # the same ID
+        with self._write():
+            (current,) = self.conn.execute(
+                f"SELECT MAX(COALESCE((SELECT value FROM sequences WHERE name = ?), 0), "
+                f"COALESCE((SELECT MAX({key_field}) FROM {name}), 0))",
+                (name,),
+            ).fetchone()
+            self.conn.execute(
+                "INSERT INTO sequences (name, value) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+                (name, current + count),
+            )
+        return current + 1
+
+    def _upsert(self, name, record, replace=True):
+        columns = self.columns[name]
+        key_fields = COLLECTIONS[name][1]
+        updates = ", ".join(f"{column} = excluded.{column}" for column in columns if column not in key_fields)
+        conflict = f"DO UPDATE SET {updates}" if replace and updates else "DO NOTHING"
+        return self.conn.execute(
+            f"INSERT INTO {name} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)}) "
+            f"ON CONFLICT ({', '.join(key_fields)}) {conflict}",
+            tuple(record.get(column) for column in columns),
+        )
+
+    def put(self, name, record, durability=None):
+        with self.lock:
+            with self._write(name):
+                self._upsert(name, record)
+            self._changed(name, "put", dict(record))
+        return dict(record)
+
+    def insert(self, name, record, durability=None):
+        with self.lock:
+            with self._write(name):
+                cursor = self._upsert(name, record, replace=False)
+            if cursor.rowcount > 0:
+                self._changed(name, "put", dict(record))
+        return cursor.rowcount > 0
+
+    def update(self, name, record, unique=None, expected=None, durability=None):
+        key_fields = COLLECTIONS[name][1]
+        key = tuple(record[field] for field in key_fields)
+        clause, params = self._key_clause(name, key if len(key_fields) > 1 else key[0])
+        for field in expected or ():
+            self._check_field(name, field)
+        with self.lock:
+            with self._write(name):
+                current = self.get(name, key if len(key_fields) > 1 else key[0])
+                if current is None or (
+                    expected and any(current.get(field) != value for field, value in expected.items())
+                ):
+                    return False
+                if unique and self.conn.execute(
+                    f"SELECT 1 FROM {name} WHERE {unique} = ? AND NOT ({clause})", (record.get(unique),) + params
+                ).fetchone():
+                    return False
+                self._upsert(name, record)
+            self._changed(name, "put", dict(record))
+        return True
+
+    def insert_many(self, name, records, unique=None, durability=None):
+        inserted, rejected = [], []
+        with self.lock:
+            with self._write(name):
+                for record in records:
+                    if unique and self.conn.execute(
+                        f"SELECT 1 FROM {name} WHERE {unique} = ?", (record.get(unique),)
+                    ).fetchone():
+                        rejected.append(record)
+                    elif self._upsert(name, record, replace=False).rowcount > 0:
+                        inserted.append(record)
+                    else:
+                        rejected.append(record)
+            for record in inserted:
+                self._changed(name, "put", dict(record))
+        return rejected
+
+    def apply_batch(self, name, inserts=(), deletes=(), durability=None):
+        with self.lock:
+            with self._write(name):
+                key_fields = COLLECTIONS[name][1]
+                conflicts, missing = [], []
+                for record in inserts:
+                    key = tuple(record[field] for field in key_fields)
+                    clause, params = self._key_clause(name, key if len(key_fields) > 1 else key[0])
+                    if self.conn.execute(f"SELECT 1 FROM {name} WHERE {clause}", params).fetchone():
+                        conflicts.append(record)
+                for key in deletes:
+                    clause, params = self._key_clause(name, key)
+                    if not self.conn.execute(f"SELECT 1 FROM {name} WHERE {clause}", params).fetchone():
+                        missing.append(key)
+                if conflicts or missing:
+                    return conflicts, missing
+                for record in inserts:
+                    self._upsert(name, record, replace=False)
+                for key in deletes:
+                    clause, params = self._key_clause(name, key)
+                    self.conn.execute(f"DELETE FROM {name} WHERE {clause}", params)
+            for record in inserts:
+                self._changed(name, "put", dict(record))
+            for key in deletes:
+                self._changed(name, "del", key)
+        return [], []
+
+    def delete_unchanged(self, groups, durability=None):
+        skipped, deleted = [], []
+        names = {name for group in groups for name, _, _, _ in group}
+        with self.lock:
+            with self._write(*names):
+                for group in groups:
+                    if not all(
+                        same_records(self.find(name, field, value), records, COLLECTIONS[name][1])
+                        for name, field, value, records in group
+                    ):
+                        skipped.append(group)
+                        continue
+                    for name, _, _, records in group:
+                        key_fields = COLLECTIONS[name][1]
+                        for record in records:
+                            key = tuple(record[field] for field in key_fields)
+                            clause, params = self._key_clause(name, key if len(key_fields) > 1 else key[0])
+                            self.conn.execute(f"DELETE FROM {name} WHERE {clause}", params)
+                            deleted.append((name, key if len(key_fields) > 1 else key[0]))
+            for name, key in deleted:
+                self._changed(name, "del", key)
+        return skipped
+
+    def delete(self, name, key, durability=None):
+        clause, params = self._key_clause(name, key)
+        with self.lock:
+            with self._write(name):
+                cursor = self.conn.execute(f"DELETE FROM {name} WHERE {clause}", params)
+            if cursor.rowcount > 0:
+                self._changed(name, "del", key)
+        return cursor.rowcount > 0
+
+    def compact(self):
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def import_json(path=SQLITE_PATH, data_dir="."):
+    # One-shot migration: loads the JSON snapshots (plus any pending change log)
+    # into the SQLite database
+    source = MemoryStore(data_dir)
+    target = SqliteStore(path)
+    with target.lock, target.conn:
+        target.conn.execute("BEGIN")
+        for name in COLLECTIONS:
+            for record in source.all(name):
+                target._upsert(name, record)
+    return {name: len(source.all(name)) for name in COLLECTIONS}
+
+
+if __name__ == "__main__":
+    # Usage: python sqlite_storage.py import [database path]
+    if len(sys.argv) < 2 or sys.argv[1] != "import":
+        sys.exit("Usage: python sqlite_storage.py import [database path]")
+    counts = import_json(sys.argv[2] if len(sys.argv) > 2 else SQLITE_PATH)
+    for name, count in counts.items():
+        print(f"Imported {count} {name}")
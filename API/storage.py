@@ -0,0 +1,911 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, single worker only
+    fcntl = None
+
+
+# Collections kept by the store: name -> (snapshot file, key fields)
+COLLECTIONS = {
+    "coaches": ("coaches.json", ("coach_id",)),
+    "fitness_classes": ("fitness_classes.json", ("class_id",)),
+    "registrations": ("registrations.json", ("user_id", "class_id")),
+    "users": ("users_db.json", ("user_id",)),
+    "revocations": ("revocations.json", ("jti",)),
+    "refresh_families": ("refresh_families.json", ("family_id",)),
+    "signing_keys": ("signing_keys.json", ("kid",)),
+    "idempotency_keys": ("idempotency_keys.json", ("key_hash",)),
+    "settings": ("settings.json", ("name",)),
+}
+
+# Fields with a secondary index in the memory store: collection -> fields
+INDEXES = {
+    "users": ("username",),
+    "refresh_families": ("user_id",),
+    "fitness_classes": ("class_type", "coach_id"),
+}
+
+# Timestamp fields kept sorted by their epoch value, for range queries
+SORTED_INDEXES = {
+    "fitness_classes": ("start_time",),
+}
+
+LOG_FILE = "storage.log"
+LOCK_FILE = "storage.lock"
+# Number of log entries after which the snapshots are rewritten and the log truncated
+COMPACT_EVERY = int(os.environ.get("STORAGE_COMPACT_EVERY", "1000"))
+# "memory" (JSON snapshots plus change log) or "sqlite"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "memory")
+# Default durability of a mutation: "none" returns once the change is applied
+# in memory, "flush" once it reached the OS, "fsync" once it is on disk
+DURABILITY_LEVELS = ("none", "flush", "fsync")
+DURABILITY = os.environ.get("STORAGE_DURABILITY", "flush")
+# How long a commit leader waits for more writers to join its batch
+COMMIT_WINDOW = float(os.environ.get("STORAGE_COMMIT_WINDOW_MS", "0")) / 1000
+# Keep the memory store coherent across worker processes sharing the data dir
+STORAGE_SHARED = os.environ.get("STORAGE_SHARED", "1") == "1"
+# Distinct field sets ProjectionCache keeps projected records for
+PROJECTION_FIELDSETS = int(os.environ.get("PROJECTION_FIELDSETS", "32"))
+
+
+def to_epoch(timestamp):
+    # Class times are ISO 8601 strings; ones without an offset (as sent by the
+    # admin form) are taken as UTC
+    moment = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def same_records(current, expected, key_fields):
+    # Whether two lists hold the same records, in any order
+    def key_of(record):
+        return tuple(record[field] for field in key_fields)
+
+    current = {key_of(record): record for record in current}
+    return len(current) == len(expected) and all(current.get(key_of(record)) == record for record in expected)
+
+
+# Utility functions to read and write JSON files
+def read_json(filename):
+    with open(filename, "r") as file:
+        return json.load(file)
+
+def write_json(data, filename):
+    # Write to a temp file next to the target and rename it into place, so a
+    # crash never leaves a truncated file behind
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(fd, "w") as file:
+            json.dump(data, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, filename)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    fsync_directory(directory)
+
+def fsync_directory(directory):
+    # Makes a rename durable; directories cannot be opened on Windows
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class GroupCommitLog:
+    # Appends go to the file buffer straight away. Callers that need their
+    # entry on disk block in wait(); the first one becomes the commit leader
+    # and flushes (and fsyncs) everything appended so far, so a burst of
+    # concurrent writers shares a single commit.
+    def __init__(self, path, window=COMMIT_WINDOW, flush_each=False):
+        self.path = path
+        self.window = window
+        # Shared logs must reach the OS before the cross-process lock is released
+        self.flush_each = flush_each
+        self.cond = threading.Condition()
+        self.file = open(path, "a")
+        self.appended = 0
+        self.flushed = 0
+        self.synced = 0
+        self.committing = False
+
+    def append(self, line):
+        with self.cond:
+            self.file.write(line)
+            self.appended += 1
+            if self.flush_each:
+                self.file.flush()
+                self.flushed = self.appended
+            return self.appended
+
+    def wait(self, sequence, durability):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"Unknown durability level {durability!r}")
+        if durability == "none":
+            return
+        with self.cond:
+            while (self.synced if durability == "fsync" else self.flushed) < sequence:
+                if self.committing:
+                    self.cond.wait()
+                    continue
+                self.committing = True
+                try:
+                    if self.window:
+                        self.cond.wait(self.window)
+                    self.file.flush()
+                    target = self.appended
+                    self.flushed = target
+                    if durability == "fsync":
+                        fd = self.file.fileno()
+                        # Let other writers append while the disk catches up
+                        self.cond.release()
+                        try:
+                            os.fsync(fd)
+                        finally:
+                            self.cond.acquire()
+                        self.synced = max(self.synced, target)
+                finally:
+                    self.committing = False
+                    self.cond.notify_all()
+
+    def reopen(self):
+        # Called once the log file has been replaced and every entry of the old
+        # one is folded into durable snapshots
+        with self.cond:
+            while self.committing:
+                self.cond.wait()
+            self.file.close()
+            self.file = open(self.path, "a")
+            self.flushed = self.synced = self.appended
+            self.cond.notify_all()
+
+
+class Collection:
+    # Reads hand out the stored dicts themselves, replaced on every put
+    stable_records = True
+
+    def __init__(self, name, filename, key_fields, indexed_fields=(), sorted_fields=()):
+        self.name = name
+        self.filename = filename
+        self.key_fields = key_fields
+        self.indexed_fields = indexed_fields
+        self.sorted_fields = sorted_fields
+        self.clear()
+
+    def clear(self):
+        self.records = {}
+        # field -> value -> keys (a dict used as an insertion-ordered set),
+        # maintained on every put/delete
+        self.indexes = {field: {} for field in self.indexed_fields}
+        # Every key in order, for keyset pagination
+        self.sorted_keys = []
+        # field -> sorted [(epoch, key)], plus key -> epoch to find the entry
+        # again; timestamps are parsed once, when the record is written
+        self.sorted_indexes = {field: [] for field in self.sorted_fields}
+        self.epochs = {field: {} for field in self.sorted_fields}
+        # Highest integer key ever stored, so new IDs are never reused
+        self.max_key = 0
+
+    def key_of(self, record):
+        if len(self.key_fields) == 1:
+            return record[self.key_fields[0]]
+        return tuple(record[field] for field in self.key_fields)
+
+    def _unindex(self, key, record):
+        for field, index in self.indexes.items():
+            keys = index.get(record.get(field))
+            if keys is not None:
+                keys.pop(key, None)
+                if not keys:
+                    del index[record.get(field)]
+        for field, column in self.sorted_indexes.items():
+            epoch = self.epochs[field].pop(key, None)
+            if epoch is not None:
+                del column[bisect_left(column, (epoch, key))]
+
+    def _index_sorted(self, key, record):
+        for field, column in self.sorted_indexes.items():
+            try:
+                epoch = to_epoch(record[field])
+            except (KeyError, TypeError, ValueError):
+                # Unparsable timestamps never match a range
+                continue
+            self.epochs[field][key] = epoch
+            insort(column, (epoch, key))
+
+    def put(self, record):
+        key = self.key_of(record)
+        old = self.records.get(key)
+        if old is not None:
+            self._unindex(key, old)
+        elif not self.sorted_keys or key > self.sorted_keys[-1]:
+            # New IDs are usually the highest yet
+            self.sorted_keys.append(key)
+        else:
+            insort(self.sorted_keys, key)
+        self.records[key] = record
+        for field, index in self.indexes.items():
+            index.setdefault(record.get(field), {})[key] = None
+        self._index_sorted(key, record)
+        if isinstance(key, int) and key > self.max_key:
+            self.max_key = key
+
+    def load(self, records):
+        for record in records:
+            self.put(record)
+
+    def delete(self, key):
+        record = self.records.pop(key, None)
+        if record is None:
+            return False
+        self._unindex(key, record)
+        del self.sorted_keys[bisect_left(self.sorted_keys, key)]
+        return True
+
+    def page(self, after, limit):
+        # Up to limit records with keys above after, in key order
+        start = 0 if after is None else bisect_right(self.sorted_keys, after)
+        return [self.records[key] for key in self.sorted_keys[start:start + limit]]
+
+    def query(self, where, between, after, limit):
+        # Records matching every where field and, if between is given as
+        # (field, low, high), with low <= epoch < high, in key order. Only the
+        # smallest candidate set is walked: an index bucket or a binary
+        # searched slice of the sorted index.
+        candidates = [self.indexes[field].get(value, {}) for field, value in where.items() if field in self.indexes]
+        if between is not None:
+            sorted_field, low, high = between
+            column = self.sorted_indexes[sorted_field]
+            start = 0 if low is None else bisect_left(column, (low,))
+            end = len(column) if high is None else bisect_left(column, (high,))
+            candidates.append(range(start, max(start, end)))
+        if not candidates:
+            keys = self.sorted_keys
+        else:
+            smallest = min(candidates, key=len)
+            keys = [column[position][1] for position in smallest] if isinstance(smallest, range) else smallest
+
+        def matches(key):
+            record = self.records[key]
+            if any(record.get(field) != value for field, value in where.items()):
+                return False
+            if between is None:
+                return True
+            epoch = self.epochs[sorted_field].get(key)
+            return epoch is not None and (low is None or epoch >= low) and (high is None or epoch < high)
+
+        found = sorted(key for key in keys if (after is None or key > after) and matches(key))
+        return [self.records[key] for key in (found if limit is None else found[:limit])]
+
+    def find(self, field, value):
+        if (field,) == self.key_fields:
+            record = self.records.get(value)
+            return [] if record is None else [record]
+        index = self.indexes.get(field)
+        if index is None:
+            return [record for record in self.records.values() if record.get(field) == value]
+        return [self.records[key] for key in index.get(value, ())]
+
+    def get(self, key):
+        return self.records.get(key)
+
+    def values(self):
+        return self.records.values()
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+
+class RegistrationTable:
+    # Registrations are bare (user_id, class_id) pairs, so instead of a dict per
+    # pair they live in two sorted uint64 arrays (16 bytes per registration):
+    # one ordered by user then class, one by class then user. Lookups and
+    # per-user/per-class filtering are binary searches over contiguous ranges;
+    # record dicts are only built for what a caller asks for.
+    OFFSET = 1 << 31
+    # Every read builds new dicts
+    stable_records = False
+
+    def __init__(self, name, filename, key_fields=("user_id", "class_id"), indexed_fields=()):
+        self.name = name
+        self.filename = filename
+        self.key_fields = key_fields
+        self.max_key = 0
+        self.clear()
+
+    def clear(self):
+        self.by_user = array("Q")
+        self.by_class = array("Q")
+
+    @classmethod
+    def _pack(cls, high, low):
+        # Maps the signed 32-bit IDs onto one sortable unsigned 64-bit value
+        if not cls._in_range(high, low):
+            raise ValueError("Registration IDs must fit in 32 bits")
+        return ((high + cls.OFFSET) << 32) | (low + cls.OFFSET)
+
+    @classmethod
+    def _unpack(cls, packed):
+        return (packed >> 32) - cls.OFFSET, (packed & 0xFFFFFFFF) - cls.OFFSET
+
+    @classmethod
+    def _in_range(cls, *ids):
+        return all(-cls.OFFSET <= value < cls.OFFSET for value in ids)
+
+    @staticmethod
+    def _position(column, packed):
+        index = bisect_left(column, packed)
+        return index if index < len(column) and column[index] == packed else None
+
+    def key_of(self, record):
+        return (record["user_id"], record["class_id"])
+
+    def put(self, record):
+        user_id, class_id = self.key_of(record)
+        packed = self._pack(user_id, class_id)
+        index = bisect_left(self.by_user, packed)
+        if index < len(self.by_user) and self.by_user[index] == packed:
+            return
+        self.by_user.insert(index, packed)
+        by_class = self._pack(class_id, user_id)
+        self.by_class.insert(bisect_left(self.by_class, by_class), by_class)
+
+    def load(self, records):
+        # Bulk path for snapshots: inserting one by one into the middle of the
+        # arrays is quadratic, so pack everything and sort each column once.
+        # The range check is done on the extremes instead of per pair.
+        user_ids = [record["user_id"] for record in records]
+        class_ids = [record["class_id"] for record in records]
+        if records and not self._in_range(min(user_ids), max(user_ids), min(class_ids), max(class_ids)):
+            raise ValueError("Registration IDs must fit in 32 bits")
+        offset = self.OFFSET
+        by_user = {((user_id + offset) << 32) | (class_id + offset) for user_id, class_id in zip(user_ids, class_ids)}
+        by_user.update(self.by_user)
+        self.by_user = array("Q", sorted(by_user))
+        by_class = {((class_id + offset) << 32) | (user_id + offset) for user_id, class_id in zip(user_ids, class_ids)}
+        by_class.update(self.by_class)
+        self.by_class = array("Q", sorted(by_class))
+
+    def delete(self, key):
+        user_id, class_id = key
+        if key not in self:
+            return False
+        index = self._position(self.by_user, self._pack(user_id, class_id))
+        del self.by_user[index]
+        del self.by_class[self._position(self.by_class, self._pack(class_id, user_id))]
+        return True
+
+    def _range(self, column, high):
+        if not self._in_range(high):
+            return array("Q")
+        start = bisect_left(column, self._pack(high, -self.OFFSET))
+        end = bisect_left(column, self._pack(high + 1, -self.OFFSET)) if high + 1 < self.OFFSET else len(column)
+        return column[start:end]
+
+    def find(self, field, value):
+        if field == "user_id":
+            return [{"user_id": value, "class_id": class_id} for _, class_id in map(self._unpack, self._range(self.by_user, value))]
+        if field == "class_id":
+            return [{"user_id": user_id, "class_id": value} for _, user_id in map(self._unpack, self._range(self.by_class, value))]
+        return [record for record in self.values() if record.get(field) == value]
+
+    def page(self, after, limit):
+        if after is None:
+            start = 0
+        elif self._in_range(*after):
+            start = bisect_right(self.by_user, self._pack(*after))
+        else:
+            start = 0 if after < (0, 0) else len(self.by_user)
+        return [
+            {"user_id": user_id, "class_id": class_id}
+            for user_id, class_id in map(self._unpack, self.by_user[start:start + limit])
+        ]
+
+    def get(self, key):
+        return {"user_id": key[0], "class_id": key[1]} if key in self else None
+
+    def values(self):
+        return ({"user_id": user_id, "class_id": class_id} for user_id, class_id in map(self._unpack, self.by_user))
+
+    def __contains__(self, key):
+        return self._in_range(*key) and self._position(self.by_user, self._pack(*key)) is not None
+
+    def __len__(self):
+        return len(self.by_user)
+
+
+class ProjectionCache:
+    # Projected copies of records for the field sets clients ask for, kept per
+    # (collection, fields) for the most recently used field sets. An entry is
+    # only served while the record it was made from is the very object the
+    # store still holds (the memory store replaces a record's dict on every
+    # put), so a projection can never be staler than its source; the store
+    # listener just keeps changed and deleted records from piling up. Only
+    # use it for collections whose records are such objects (see
+    # stable_records()); for anything else every entry would be a miss.
+    def __init__(self, max_fieldsets=PROJECTION_FIELDSETS):
+        self.max_fieldsets = max_fieldsets
+        self.lock = threading.Lock()
+        self.projections = OrderedDict()  # (name, fields) -> {key: (record, projected)}
+
+    def project(self, name, key, record, fields):
+        with self.lock:
+            cache = self.projections.get((name, fields))
+            if cache is None:
+                cache = self.projections[(name, fields)] = {}
+                while len(self.projections) > self.max_fieldsets:
+                    self.projections.popitem(last=False)
+            else:
+                self.projections.move_to_end((name, fields))
+            entry = cache.get(key)
+            if entry is not None and entry[0] is record:
+                return entry[1]
+        projected = {field: record.get(field) for field in fields}
+        with self.lock:
+            cache[key] = (record, projected)
+        return projected
+
+    def on_change(self, name, op, payload):
+        key_fields = COLLECTIONS[name][1]
+        if op == "put":
+            key = payload[key_fields[0]] if len(key_fields) == 1 else tuple(payload[field] for field in key_fields)
+        else:
+            key = payload
+        with self.lock:
+            for (cached_name, _), cache in self.projections.items():
+                if cached_name != name:
+                    continue
+                if op == "reset":
+                    cache.clear()
+                else:
+                    cache.pop(key, None)
+
+
+# Collections with a specialised in-memory representation
+TABLES = {
+    "registrations": RegistrationTable,
+}
+
+
+class MemoryStore:
+    # Keeps every collection in memory. Mutations are appended to a log of
+    # record-level changes, which is replayed on top of the JSON snapshots at
+    # startup and folded back into them by compact().
+    #
+    # With several workers the log is the shared source of truth: writers hold
+    # an flock while they catch up with, and append to, the log; readers stat
+    # the log and replay whatever other workers appended since they last
+    # looked. Compaction swaps in a new log file whose first line names the log
+    # it replaced and how far that was folded into the snapshots. A worker
+    # that has the replaced log open reads it to the end and carries on with
+    # the new one; only a worker that missed a whole compaction reloads.
+    def __init__(self, data_dir=".", log_file=LOG_FILE, compact_every=COMPACT_EVERY, shared=STORAGE_SHARED):
+        self.data_dir = data_dir
+        self.compact_every = compact_every
+        self.shared = shared and fcntl is not None
+        self.lock = threading.RLock()
+        self.lock_file = open(os.path.join(data_dir, LOCK_FILE), "a") if self.shared else None
+        self.lock_depth = 0
+        self.listeners = []
+        self.collections = {
+            name: TABLES[name](name, filename, key_fields, INDEXES.get(name, ()))
+            if name in TABLES
+            else Collection(name, filename, key_fields, INDEXES.get(name, ()), SORTED_INDEXES.get(name, ()))
+            for name, (filename, key_fields) in COLLECTIONS.items()
+        }
+        self.sequences = {}
+        self.log_path = os.path.join(data_dir, log_file)
+        # Kept open across compactions, so the tail of a replaced log can
+        # still be read
+        self.log_reader = None
+        with self.lock, self._file_lock():
+            self._load()
+            self.log = GroupCommitLog(self.log_path, flush_each=self.shared)
+
+    @contextmanager
+    def _file_lock(self):
+        # Cross-process write lock; re-entrant within this process (callers
+        # already hold self.lock)
+        if self.lock_file is None:
+            yield
+            return
+        if self.lock_depth == 0:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        self.lock_depth += 1
+        try:
+            yield
+        finally:
+            self.lock_depth -= 1
+            if self.lock_depth == 0:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        # Versions are rebuilt from the log (see compact()), so every worker
+        # arrives at the same numbers for the same data
+        self.versions = dict.fromkeys(self.collections, 0)
+        self.modified = dict.fromkeys(self.collections)
+        for collection in self.collections.values():
+            collection.clear()
+            path = os.path.join(self.data_dir, collection.filename)
+            try:
+                records = read_json(path)
+            except FileNotFoundError:
+                records = []
+                write_json(records, path)
+            collection.load(records)
+            # Until the log says otherwise, the snapshot is the last change
+            self.modified[collection.name] = os.stat(path).st_mtime
+        self.sequences = {}
+        self.log_entries = 0
+        self.log_offset = 0
+        # Logs written by compact() carry an ID in their first line
+        self.log_id = None
+        if self.log_reader is not None:
+            self.log_reader.close()
+        open(self.log_path, "a").close()
+        self.log_reader = open(self.log_path, "rb")
+        self.log_inode = os.fstat(self.log_reader.fileno()).st_ino
+        self._replay(locked=True)
+
+    def _replay(self, locked):
+        # Applies log entries from self.log_offset onwards. A line without its
+        # newline is either still being written by another worker or, if we
+        # hold the write lock, was torn by a crash and gets dropped.
+        log = self.log_reader
+        log.seek(self.log_offset)
+        for line in log:
+            if not line.endswith(b"\n"):
+                # Under the write lock the path is still our log
+                if locked:
+                    os.truncate(self.log_path, self.log_offset)
+                break
+            self.log_offset += len(line)
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            self._apply(entry)
+            self.log_entries += 1
+
+    def _refresh(self, locked=False):
+        # Cheap version check: the log's inode and size change whenever
+        # another worker appends or compacts
+        if not self.shared:
+            return
+        stat = os.stat(self.log_path)
+        if stat.st_ino != self.log_inode:
+            if not self._follow_compaction():
+                with self._file_lock():
+                    self._load()
+                for name in self.collections:
+                    self._notify(name, "reset", None)
+            self.log.reopen()
+        elif stat.st_size != self.log_offset:
+            self._replay(locked)
+
+    def _follow_compaction(self):
+        # Another worker compacted. Whatever it folded into the snapshots is
+        # what it had read of our log, which ended where its compaction header
+        # says. Once we have read the old log that far too, our state is the
+        # snapshots' and the new log continues from there. The compactor held
+        # the write lock, so the old log is complete and no longer written to.
+        self._replay(locked=False)
+        try:
+            reader = open(self.log_path, "rb")
+        except FileNotFoundError:
+            return False
+        try:
+            header = json.loads(reader.readline())
+        except ValueError:
+            header = None
+        if not (
+            isinstance(header, dict)
+            and header.get("op") == "log"
+            and header.get("prev") == self.log_id
+            and header.get("prev_end") == self.log_offset
+        ):
+            reader.close()
+            return False
+        self.log_reader.close()
+        self.log_reader = reader
+        self.log_inode = os.fstat(reader.fileno()).st_ino
+        self.log_offset = 0
+        self.log_entries = 0
+        # The header's sequences and versions match ours; replaying them is
+        # harmless and picks up the new log's ID
+        self._replay(locked=False)
+        return True
+
+    def refresh(self):
+        # Applies changes made by other workers now, notifying listeners
+        with self.lock:
+            self._refresh()
+
+    def subscribe(self, listener):
+        # listener(name, op, payload) runs after every change, including ones
+        # replayed from other workers; op "reset" means the whole collection
+        # was reloaded
+        self.listeners.append(listener)
+
+    def _notify(self, name, op, payload):
+        for listener in self.listeners:
+            listener(name, op, payload)
+
+    def _apply(self, entry):
+        if entry["op"] == "log":
+            self.log_id = entry["id"]
+            return
+        name = entry["c"]
+        if entry["op"] == "seq":
+            self.sequences[name] = max(self.sequences.get(name, 0), entry["v"])
+            return
+        if entry["op"] == "ver":
+            self.versions[name] = entry["v"]
+            self.modified[name] = entry["t"]
+            return
+        # New entries are stamped here, before they are written to the log
+        entry.setdefault("t", time.time())
+        if entry["op"] == "batch":
+            # Several changes written as one line, so a crash keeps all or none
+            for change in entry["e"]:
+                change.setdefault("t", entry["t"])
+                self._apply(change)
+            return
+        collection = self.collections[name]
+        if entry["op"] == "put":
+            collection.put(entry["r"])
+            payload = entry["r"]
+        else:
+            key = entry["k"]
+            payload = tuple(key) if isinstance(key, list) else key
+            collection.delete(payload)
+        self.versions[name] += 1
+        self.modified[name] = entry["t"]
+        self._notify(name, entry["op"], payload)
+
+    def _append(self, entry):
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        sequence = self.log.append(line)
+        self.log_offset += len(line)
+        self.log_entries += 1
+        if self.log_entries >= self.compact_every:
+            self.compact()
+        return sequence
+
+    def all(self, name):
+        with self.lock:
+            self._refresh()
+            return list(self.collections[name].values())
+
+    def get(self, name, key):
+        with self.lock:
+            self._refresh()
+            return self.collections[name].get(key)
+
+    def find(self, name, field, value):
+        with self.lock:
+            self._refresh()
+            return self.collections[name].find(field, value)
+
+    def page(self, name, after=None, limit=100):
+        with self.lock:
+            self._refresh()
+            return self.collections[name].page(after, limit)
+
+    def query(self, name, where=None, between=None, after=None, limit=None):
+        with self.lock:
+            self._refresh()
+            return self.collections[name].query(where or {}, between, after, limit)
+
+    def stable_records(self, name):
+        # Whether reads return the same record object until it changes
+        return self.collections[name].stable_records
+
+    def version(self, name):
+        # (change count, time of the last change or None), equal in every worker
+        with self.lock:
+            self._refresh()
+            return self.versions[name], self.modified[name]
+
+    def next_id(self, name, count=1, durability=DURABILITY):
+        # Reserves count consecutive IDs and returns the first. IDs are reserved
+        # in the log, so two workers never hand out the same one.
+        with self.lock, self._file_lock():
+            self._refresh(locked=True)
+            value = max(self.collections[name].max_key, self.sequences.get(name, 0)) + 1
+            entry = {"op": "seq", "c": name, "v": value + count - 1}
+            self._apply(entry)
+            sequence = self._append(entry)
+        self.log.wait(sequence, durability)
+        return value
+
+    def put(self, name, record, durability=DURABILITY):
+        entry = {"op": "put", "c": name, "r": dict(record)}
+        with self.lock, self._file_lock():
+            self._refresh(locked=True)
+            self._apply(entry)
+            sequence = self._append(entry)
+        self.log.wait(sequence, durability)
+        return entry["r"]
+
+    def insert(self, name, record, durability=DURABILITY):
+        # Like put(), but refuses to overwrite an existing record
+        collection = self.collections[name]
+        entry = {"op": "put", "c": name, "r": dict(record)}
+        with self.lock, self._file_lock():
+            self._refresh(locked=True)
+            if collection.key_of(record) in collection:
+                return False
+            self._apply(entry)
+            sequence = self._append(entry)
+        self.log.wait(sequence, durability)
+        return True
+
+    def update(self, name, record, unique=None, expected=None, durability=DURABILITY):
+        # Like put(), but only overwrites a record that exists and still has
+        # the field values in expected, and refuses if another record already
+        # has the same value in the unique field. Returns whether the record
+        # was written.
+        collection = self.collections[name]
+        key = collection.key_of(record)
+        entry = {"op": "put", "c": name, "r": dict(record)}
+        with self.lock, self._file_lock():
+            self._refresh(locked=True)
+            current = collection.get(key)
+            if current is None or (
+                expected and any(current.get(field) != value for field, value in expected.items())
+            ) or (
+                unique and any(collection.key_of(other) != key for other in collection.find(unique, record.get(unique)))
+            ):
+                return False
+            self._apply(entry)
+            sequence = self._append(entry)
+        self.log.wait(sequence, durability)
+        return True
+
+    def insert_many(self, name, records, unique=None, durability=DURABILITY):
+        # Inserts every record that neither overwrites an existing one nor
+        # repeats a taken value of the unique field, in a single transaction.
+        # Returns the records left out.
+        collection = self.collections[name]
+        accepted, rejected = [], []
+        keys, values = set(), set()
+        with self.lock, self._file_lock():
+            self._refresh(locked=True)
+            for record in records:
+                key = collection.key_of(record)
+                value = record.get(unique) if unique else None
+                if key in collection or key in keys or (
+                    unique and (value in values or collection.find(unique, value))
+                ):
+                    rejected.append(record)
+                    continue
+                accepted.append({"op": "put", "c": name, "r": dict(record)})
+                keys.add(key)
+                values.add(value)
+            if not accepted:
+                return rejected
+            entry = {"op": "batch", "c": name, "e": accepted}
+            self._apply(entry)
+            sequence = self._append(entry)
+        self.log.wait(sequence, durability)
+        return rejected
+
+    def apply_batch(self, name, inserts=(), deletes=(), durability=DURABILITY):
+        # All or nothing: every insert must be new and every key to delete must
+        # exist, otherwise nothing changes. Returns the inserts and delete keys
+        # that failed; both empty means the batch was applied.
+        collection = self.collections[name]
+        with self.lock, self._file_lock():
+            self._refresh(locked=True)
+            conflicts = [record for record in inserts if collection.key_of(record) in collection]
+            missing = [key for key in deletes if key not in collection]
+            if conflicts or missing or not (inserts or deletes):
+                return conflicts, missing
+            changes = [{"op": "put", "c": name, "r": dict(record)} for record in inserts]
+            changes += [{"op": "del", "c": name, "k": key} for key in deletes]
+            entry = {"op": "batch", "c": name, "e": changes}
+            self._apply(entry)
+            sequence = self._append(entry)
+        self.log.wait(sequence, durability)
+        return [], []
+
+    def delete_unchanged(self, groups, durability=DURABILITY):
+        # Each group is a list of (name, field, value, records), claiming that
+        # the records of name whose field equals value are exactly these. A
+        # group is deleted only if every claim still holds; the rest are left
+        # alone. All deletes go in one commit. Returns the groups left alone.
+        skipped, changes = [], []
+        with self.lock, self._file_lock():
+            self._refresh(locked=True)
+            for group in groups:
+                if not all(
+                    same_records(self.collections[name].find(field, value), records, COLLECTIONS[name][1])
+                    for name, field, value, records in group
+                ):
+                    skipped.append(group)
+                    continue
+                changes += [
+                    {"op": "del", "c": name, "k": self.collections[name].key_of(record)}
+                    for name, _, _, records in group
+                    for record in records
+                ]
+            if not changes:
+                return skipped
+            entry = {"op": "batch", "c": changes[0]["c"], "e": changes}
+            self._apply(entry)
+            sequence = self._append(entry)
+        self.log.wait(sequence, durability)
+        return skipped
+
+    def delete(self, name, key, durability=DURABILITY):
+        entry = {"op": "del", "c": name, "k": key}
+        with self.lock, self._file_lock():
+            self._refresh(locked=True)
+            if key not in self.collections[name]:
+                return False
+            self._apply(entry)
+            sequence = self._append(entry)
+        self.log.wait(sequence, durability)
+        return True
+
+    def compact(self):
+        with self.lock, self._file_lock():
+            self._refresh(locked=True)
+            for collection in self.collections.values():
+                path = os.path.join(self.data_dir, collection.filename)
+                write_json(list(collection.values()), path)
+            # Start a fresh log file (new inode) that names the log and offset
+            # it replaces, carries over the reserved ID sequences and the
+            # collection versions, and rename it over the old one. Every
+            # collection gets a version entry, even one never changed: its
+            # snapshot was just rewritten, and a worker that reloads would
+            # otherwise take the new mtime as its last change.
+            log_id = uuid.uuid4().hex
+            entries = [{"op": "log", "id": log_id, "prev": self.log_id, "prev_end": self.log_offset}]
+            entries += [{"op": "seq", "c": name, "v": value} for name, value in self.sequences.items()]
+            entries += [
+                {"op": "ver", "c": name, "v": version, "t": self.modified[name]}
+                for name, version in self.versions.items()
+            ]
+            lines = [json.dumps(entry, separators=(",", ":")) + "\n" for entry in entries]
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.log_path)), prefix=".tmp-")
+            with os.fdopen(fd, "w") as file:
+                file.writelines(lines)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.log_path)
+            fsync_directory(os.path.dirname(os.path.abspath(self.log_path)))
+            self.log.reopen()
+            self.log_reader.close()
+            self.log_reader = open(self.log_path, "rb")
+            self.log_inode = os.fstat(self.log_reader.fileno()).st_ino
+            self.log_id = log_id
+            self.log_offset = sum(len(line) for line in lines)
+            self.log_entries = len(lines)
+
+
+def open_store():
+    if STORAGE_BACKEND == "sqlite":
+        from sqlite_storage import SqliteStore
+        return SqliteStore()
+    return MemoryStore()
@@ -0,0 +1,140 @@
+import os
+import threading
+
+import pytest
+
+import storage
+from storage import GroupCommitLog
+
+
+def read(path):
+    with open(path) as file:
+        return file.read()
+
+
+def test_append_numbers_entries(tmp_path):
+    log = GroupCommitLog(str(tmp_path / "log"))
+    assert [log.append(f"{i}\n") for i in range(3)] == [1, 2, 3]
+
+
+def test_none_leaves_entries_buffered(tmp_path):
+    path = str(tmp_path / "log")
+    log = GroupCommitLog(path)
+    log.wait(log.append("a\n"), "none")
+    assert read(path) == ""
+    assert log.flushed == 0
+
+
+def test_flush_makes_entries_visible_without_fsync(tmp_path, monkeypatch):
+    fsyncs = []
+    monkeypatch.setattr(storage.os, "fsync", fsyncs.append)
+    path = str(tmp_path / "log")
+    log = GroupCommitLog(path)
+    log.wait(log.append("a\n"), "flush")
+    assert read(path) == "a\n"
+    assert fsyncs == []
+    assert (log.flushed, log.synced) == (1, 0)
+
+
+def test_fsync_waits_for_the_disk(tmp_path, monkeypatch):
+    fsyncs = []
+    monkeypatch.setattr(storage.os, "fsync", fsyncs.append)
+    log = GroupCommitLog(str(tmp_path / "log"))
+    log.wait(log.append("a\n"), "fsync")
+    assert len(fsyncs) == 1
+    assert log.synced == 1
+    # Already durable: no second commit
+    log.wait(1, "fsync")
+    log.wait(1, "flush")
+    assert len(fsyncs) == 1
+
+
+def test_unknown_durability_is_rejected(tmp_path):
+    log = GroupCommitLog(str(tmp_path / "log"))
+    with pytest.raises(ValueError):
+        log.wait(log.append("a\n"), "sometimes")
+
+
+def test_flush_each_flushes_on_append(tmp_path):
+    path = str(tmp_path / "log")
+    log = GroupCommitLog(path, flush_each=True)
+    log.append("a\n")
+    assert read(path) == "a\n"
+    assert log.flushed == 1
+
+
+def test_concurrent_writers_share_one_fsync(tmp_path, monkeypatch):
+    fsyncs = []
+    monkeypatch.setattr(storage.os, "fsync", fsyncs.append)
+    log = GroupCommitLog(str(tmp_path / "log"))
+    sequences = [log.append(f"{i}\n") for i in range(8)]
+    threads = [threading.Thread(target=log.wait, args=(sequence, "fsync")) for sequence in sequences]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(fsyncs) == 1
+    assert log.synced == 8
+
+
+def test_writers_append_while_the_leader_fsyncs(tmp_path, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    fsyncs = []
+
+    def slow_fsync(fd):
+        fsyncs.append(fd)
+        started.set()
+        assert release.wait(5)
+
+    monkeypatch.setattr(storage.os, "fsync", slow_fsync)
+    path = str(tmp_path / "log")
+    log = GroupCommitLog(path)
+    leader = threading.Thread(target=log.wait, args=(log.append("a\n"), "fsync"))
+    leader.start()
+    assert started.wait(5)
+
+    # The lock is free during the fsync, so appends and flushes go through
+    # without waiting for it
+    second = log.append("b\n")
+    assert second == 2
+    follower = threading.Thread(target=log.wait, args=(second, "fsync"))
+    follower.start()
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert not leader.is_alive() and not follower.is_alive()
+    # The first commit only covered entry 1, so entry 2 needed its own
+    assert len(fsyncs) == 2
+    assert log.synced == 2
+    assert read(path) == "a\nb\n"
+
+
+def test_window_lets_more_writers_join(tmp_path, monkeypatch):
+    fsyncs = []
+    monkeypatch.setattr(storage.os, "fsync", fsyncs.append)
+    log = GroupCommitLog(str(tmp_path / "log"), window=0.2)
+    first = log.append("a\n")
+    leader = threading.Thread(target=log.wait, args=(first, "fsync"))
+    leader.start()
+    # Appended while the leader is still waiting out its window
+    second = log.append("b\n")
+    follower = threading.Thread(target=log.wait, args=(second, "fsync"))
+    follower.start()
+    leader.join(5)
+    follower.join(5)
+    assert len(fsyncs) == 1
+    assert log.synced == 2
+
+
+def test_reopen_follows_a_replaced_file(tmp_path):
+    path = str(tmp_path / "log")
+    log = GroupCommitLog(path)
+    log.wait(log.append("old\n"), "flush")
+    os.replace(str(tmp_path / "log"), str(tmp_path / "old-log"))
+    open(path, "w").close()
+    log.reopen()
+    assert log.flushed == log.synced == 1
+    log.wait(log.append("new\n"), "flush")
+    assert read(path) == "new\n"
+    assert read(str(tmp_path / "old-log")) == "old\n"
@@ -0,0 +1,130 @@
+import hashlib
+import json
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from idempotency import IdempotencyInProgress, IdempotencyKeys, IdempotencyMiddleware, IdempotencyMismatch
+from storage import MemoryStore
+
+
+@pytest.fixture
+def keys(tmp_path):
+    return IdempotencyKeys(MemoryStore(str(tmp_path)))
+
+
+def make_client(keys):
+    app = FastAPI()
+    app.state.calls = 0
+
+    @app.post("/orders")
+    def create_order(item: dict, fail: int = 0):
+        app.state.calls += 1
+        if fail == 1:
+            raise HTTPException(status_code=503, detail="Try later")
+        if fail == 2:
+            raise RuntimeError("boom")
+        return {"order": app.state.calls, "item": item}
+
+    app.add_middleware(
+        IdempotencyMiddleware,
+        keys=keys,
+        paths={"/orders"},
+        owner_of=lambda headers: headers.get("x-user", ""),
+    )
+    return TestClient(app, raise_server_exceptions=False)
+
+
+def body(item=None):
+    return json.dumps(item or {"sku": "a"}).encode()
+
+
+def post(client, key, item=None, **params):
+    return client.post(
+        "/orders",
+        params=params,
+        content=body(item),
+        headers={"Idempotency-Key": key, "Content-Type": "application/json"},
+    )
+
+
+def test_retry_replays_the_stored_response(keys):
+    client = make_client(keys)
+    first = post(client, "k1")
+    second = post(client, "k1")
+    assert first.status_code == second.status_code == 200
+    assert second.json() == first.json() == {"order": 1, "item": {"sku": "a"}}
+    assert second.headers["idempotent-replayed"] == "true"
+    assert "idempotent-replayed" not in first.headers
+    assert client.app.state.calls == 1
+
+
+def test_keys_are_scoped_to_their_owner(keys):
+    client = make_client(keys)
+    post(client, "k1")
+    other = client.post("/orders", json={"sku": "a"}, headers={"Idempotency-Key": "k1", "X-User": "other"})
+    assert other.json()["order"] == 2
+
+
+def test_request_in_progress_gets_409(keys):
+    client = make_client(keys)
+    # The first request's pending record, as if it were still running
+    fingerprint = hashlib.sha256(b"\n".join([b"/orders", b"", body()])).hexdigest()
+    assert keys.begin("", "k1", fingerprint) is None
+    with pytest.raises(IdempotencyInProgress):
+        keys.begin("", "k1", fingerprint)
+    response = post(client, "k1")
+    assert response.status_code == 409
+    assert response.headers["retry-after"] == "1"
+    assert client.app.state.calls == 0
+
+
+def test_same_key_with_a_different_request_gets_422(keys):
+    client = make_client(keys)
+    post(client, "k1")
+    response = post(client, "k1", item={"sku": "b"})
+    assert response.status_code == 422
+    assert client.app.state.calls == 1
+
+
+def test_failed_requests_are_not_stored(keys):
+    client = make_client(keys)
+    assert post(client, "k1", fail=1).status_code == 503
+    assert post(client, "k1", fail=2).status_code == 500
+    # Both failures released the key, so the retry runs for real
+    response = post(client, "k1")
+    assert response.status_code == 200
+    assert "idempotent-replayed" not in response.headers
+    assert client.app.state.calls == 3
+
+
+def test_invalid_key_gets_400(keys):
+    client = make_client(keys)
+    assert post(client, "").status_code == 400
+    assert post(client, "x" * 256).status_code == 400
+    assert client.app.state.calls == 0
+
+
+def test_expired_pending_key_is_taken_over(tmp_path):
+    keys = IdempotencyKeys(MemoryStore(str(tmp_path)), pending_ttl=0)
+    assert keys.begin("", "k1", "f") is None
+    # The worker holding it died; the key is free again once it expires
+    assert keys.begin("", "k1", "f") is None
+
+
+def test_expired_result_is_not_replayed(tmp_path):
+    keys = IdempotencyKeys(MemoryStore(str(tmp_path)), ttl=0)
+    client = make_client(keys)
+    post(client, "k1")
+    response = post(client, "k1", item={"sku": "b"})
+    assert response.status_code == 200
+    assert response.json()["order"] == 2
+
+
+def test_mismatch_is_reported_by_begin(keys):
+    keys.begin("", "k1", "f")
+    keys.complete("", "k1", "f", 200, [], "{}")
+    with pytest.raises(IdempotencyMismatch):
+        keys.begin("", "k1", "g")
+    assert keys.begin("", "k1", "f")["status_code"] == 200
@@ -0,0 +1,170 @@
+import json
+import os
+
+import pytest
+
+import storage
+from storage import MemoryStore
+
+pytestmark = pytest.mark.skipif(storage.fcntl is None, reason="shared stores need flock")
+
+
+def coach(coach_id, name="Coach"):
+    return {"coach_id": coach_id, "first_name": name}
+
+
+def open_pair(tmp_path, compact_every=1000):
+    # Two workers sharing one data directory
+    return (
+        MemoryStore(str(tmp_path), compact_every=compact_every, shared=True),
+        MemoryStore(str(tmp_path), compact_every=compact_every, shared=True),
+    )
+
+
+def listen(store):
+    events = []
+    store.subscribe(lambda name, op, payload: events.append((name, op, payload)))
+    return events
+
+
+def test_writes_are_replayed_by_other_workers(tmp_path):
+    a, b = open_pair(tmp_path)
+    events = listen(b)
+    a.put("coaches", coach(1))
+    assert b.get("coaches", 1) == coach(1)
+    assert events == [("coaches", "put", coach(1))]
+
+    b.delete("coaches", 1)
+    assert a.get("coaches", 1) is None
+    assert b.get("coaches", 1) is None
+
+
+def test_ids_are_never_handed_out_twice(tmp_path):
+    a, b = open_pair(tmp_path)
+    first = a.next_id("fitness_classes", count=5)
+    second = b.next_id("fitness_classes")
+    assert second == first + 5
+    assert a.next_id("fitness_classes") == second + 1
+
+
+def test_insert_sees_records_from_other_workers(tmp_path):
+    a, b = open_pair(tmp_path)
+    assert a.insert("registrations", {"user_id": 1, "class_id": 2})
+    assert not b.insert("registrations", {"user_id": 1, "class_id": 2})
+
+
+def test_versions_agree_across_workers(tmp_path):
+    a, b = open_pair(tmp_path, compact_every=3)
+    for coach_id in range(5):
+        a.put("coaches", coach(coach_id))
+    b.delete("coaches", 0)
+    assert a.version("coaches") == b.version("coaches")
+    assert a.version("coaches")[0] == 6
+
+
+def test_compaction_keeps_other_workers_state(tmp_path):
+    a, b = open_pair(tmp_path, compact_every=4)
+    b.get("coaches", 0)
+    events = listen(b)
+    # The fourth entry makes a compact; b has not looked since the first
+    for coach_id in range(4):
+        a.put("coaches", coach(coach_id))
+    old_reader = b.log_reader
+    assert b.all("coaches") == [coach(coach_id) for coach_id in range(4)]
+    # Followed the new log instead of reloading the snapshots
+    assert b.log_reader is not old_reader
+    assert b.log_id == a.log_id is not None
+    assert all(op == "put" for _, op, _ in events)
+    assert len(events) == 4
+
+    a.put("coaches", coach(9))
+    assert b.get("coaches", 9) == coach(9)
+    b.put("coaches", coach(10))
+    assert a.get("coaches", 10) == coach(10)
+
+
+def test_compaction_by_a_writer_is_followed_by_the_next_writer(tmp_path):
+    a, b = open_pair(tmp_path, compact_every=2)
+    a.put("coaches", coach(1))
+    a.put("coaches", coach(2))
+    # b catches up inside its own write
+    b.put("coaches", coach(3))
+    assert {record["coach_id"] for record in a.all("coaches")} == {1, 2, 3}
+    assert {record["coach_id"] for record in b.all("coaches")} == {1, 2, 3}
+
+
+def test_missing_a_whole_compaction_reloads(tmp_path):
+    a, b = open_pair(tmp_path, compact_every=2)
+    b.get("coaches", 0)
+    events = listen(b)
+    for coach_id in range(5):
+        a.put("coaches", coach(coach_id))
+    assert len(b.all("coaches")) == 5
+    assert ("coaches", "reset", None) in events
+    assert b.log_id == a.log_id
+    assert b.version("coaches") == a.version("coaches")
+
+
+def test_restart_replays_snapshots_and_log(tmp_path):
+    a, _ = open_pair(tmp_path, compact_every=3)
+    for coach_id in range(4):
+        a.put("coaches", coach(coach_id))
+    a.delete("coaches", 0)
+    a.put("registrations", {"user_id": 7, "class_id": 8})
+    restarted = MemoryStore(str(tmp_path), shared=True)
+    assert sorted(record["coach_id"] for record in restarted.all("coaches")) == [1, 2, 3]
+    assert restarted.get("registrations", (7, 8)) == {"user_id": 7, "class_id": 8}
+    assert restarted.version("coaches") == a.version("coaches")
+
+
+def test_untouched_collections_keep_their_version_across_compaction(tmp_path):
+    MemoryStore(str(tmp_path), shared=True)
+    # Snapshots from long ago, so rewriting them changes their mtime
+    for name in os.listdir(tmp_path):
+        if name.endswith(".json"):
+            os.utime(tmp_path / name, (1000, 1000))
+    a, follower = open_pair(tmp_path, compact_every=3)
+    for coach_id in range(3):
+        a.put("coaches", coach(coach_id))
+    restarted = MemoryStore(str(tmp_path), shared=True)
+    assert follower.version("users") == restarted.version("users") == a.version("users") == (0, 1000)
+    assert follower.version("coaches") == restarted.version("coaches")
+
+
+def test_torn_last_line_is_dropped(tmp_path):
+    a, _ = open_pair(tmp_path)
+    a.put("coaches", coach(1))
+    log_path = os.path.join(str(tmp_path), storage.LOG_FILE)
+    with open(log_path, "a") as log:
+        log.write(json.dumps({"op": "put", "c": "coaches", "r": coach(2)})[:20])
+    restarted = MemoryStore(str(tmp_path), shared=True)
+    assert restarted.get("coaches", 2) is None
+    restarted.put("coaches", coach(3))
+    assert a.get("coaches", 3) == coach(3)
+    assert MemoryStore(str(tmp_path), shared=True).get("coaches", 3) == coach(3)
+
+
+def test_delete_unchanged_skips_groups_that_changed(tmp_path):
+    a, b = open_pair(tmp_path)
+    for class_id in (1, 2, 3):
+        a.put("fitness_classes", {"class_id": class_id, "class_type": "Yoga"})
+        a.put("registrations", {"user_id": 10, "class_id": class_id})
+    groups = [
+        [
+            ("fitness_classes", "class_id", class_id, [a.get("fitness_classes", class_id)]),
+            ("registrations", "class_id", class_id, a.find("registrations", "class_id", class_id)),
+        ]
+        for class_id in (1, 2, 3)
+    ]
+    # Changed by another worker after the groups were read
+    b.put("fitness_classes", {"class_id": 2, "class_type": "Pilates"})
+    b.insert("registrations", {"user_id": 11, "class_id": 3})
+    version = a.version("registrations")[0]
+
+    assert a.delete_unchanged(groups) == groups[1:]
+    assert a.get("fitness_classes", 1) is None
+    assert a.find("registrations", "class_id", 1) == []
+    assert b.get("fitness_classes", 2)["class_type"] == "Pilates"
+    assert len(b.find("registrations", "class_id", 3)) == 2
+    # One registration deleted, in the same commit as its class
+    assert a.version("registrations")[0] == version + 1
@@ -0,0 +1,64 @@
+from ratelimit import SlidingWindowLimiter
+
+
+def limiter(limit=3, max_keys=100):
+    return SlidingWindowLimiter(limit, window=60, max_keys=max_keys)
+
+
+def test_attempts_under_the_limit_pass():
+    rate = limiter()
+    for now in (0, 1):
+        assert rate.retry_after("k", now) is None
+        rate.record("k", now)
+    assert rate.retry_after("k", 2) is None
+
+
+def test_attempts_over_the_limit_wait_for_the_window_to_end():
+    rate = limiter()
+    for now in (0, 1, 2):
+        rate.record("k", now)
+    assert rate.retry_after("k", 10) == 50
+    # Other keys are counted separately
+    assert rate.retry_after("other", 10) is None
+
+
+def test_previous_window_decays_after_rollover():
+    rate = limiter()
+    for now in (0, 1, 2):
+        rate.record("k", now)
+    # At the rollover the previous window still counts in full
+    assert rate.retry_after("k", 60) == 1
+    rate.record("k", 65)
+    # 1 + 3 * 55/60 attempts in the sliding window; the previous window's
+    # share falls to 2 at 80 seconds and below it right after
+    assert rate.retry_after("k", 65) == 15
+    assert rate.retry_after("k", 80) == 1
+    assert rate.retry_after("k", 80.5) is None
+
+
+def test_counts_older_than_the_previous_window_are_dropped():
+    rate = limiter()
+    for now in (0, 1, 2):
+        rate.record("k", now)
+    assert rate.retry_after("k", 120) is None
+    rate.record("k", 120)
+    assert rate.counters["k"] == [120, 1, 0]
+
+
+def test_retry_after_is_at_least_one_second():
+    rate = limiter()
+    for now in (0, 1, 2):
+        rate.record("k", now)
+    assert rate.retry_after("k", 59.9) == 1
+
+
+def test_least_recently_seen_keys_are_evicted():
+    rate = limiter(limit=1, max_keys=2)
+    rate.record("a", 0)
+    rate.record("b", 0)
+    rate.record("a", 1)
+    rate.record("c", 2)
+    assert list(rate.counters) == ["a", "c"]
+    # The evicted key starts afresh
+    assert rate.retry_after("b", 3) is None
+    assert rate.retry_after("a", 3) == 57
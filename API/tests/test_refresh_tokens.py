@@ -0,0 +1,73 @@
+import pytest
+
+from auth import InvalidRefreshToken, RefreshTokens
+from sqlite_storage import SqliteStore
+from storage import MemoryStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return SqliteStore(str(tmp_path / "coaching.db"))
+    return MemoryStore(str(tmp_path))
+
+
+def test_rotation_keeps_one_record_per_family(store):
+    tokens = RefreshTokens(store)
+    token, family_id = tokens.issue(7)
+    for _ in range(3):
+        user_id, rotated_family, token = tokens.rotate(token)
+        assert (user_id, rotated_family) == (7, family_id)
+    assert len(store.all("refresh_families")) == 1
+
+
+def test_reusing_a_spent_token_revokes_the_family(store):
+    tokens = RefreshTokens(store)
+    first, _ = tokens.issue(7)
+    _, _, second = tokens.rotate(first)
+    with pytest.raises(InvalidRefreshToken):
+        tokens.rotate(first)
+    # The legitimate holder is logged out too
+    with pytest.raises(InvalidRefreshToken):
+        tokens.rotate(second)
+
+
+def test_unknown_token_of_a_family_revokes_it(store):
+    tokens = RefreshTokens(store)
+    token, family_id = tokens.issue(7)
+    with pytest.raises(InvalidRefreshToken):
+        tokens.rotate(f"{family_id}.forged")
+    with pytest.raises(InvalidRefreshToken):
+        tokens.rotate(token)
+
+
+def test_unknown_family_is_rejected(store):
+    tokens = RefreshTokens(store)
+    token, _ = tokens.issue(7)
+    with pytest.raises(InvalidRefreshToken):
+        tokens.rotate("nope.nope")
+    tokens.rotate(token)
+
+
+def test_family_expiry_is_not_extended_by_rotation(store, monkeypatch):
+    tokens = RefreshTokens(store, lifetime=100)
+    now = [1000.0]
+    monkeypatch.setattr("auth.time.time", lambda: now[0])
+    token, family_id = tokens.issue(7)
+    now[0] = 1060.0
+    _, _, token = tokens.rotate(token)
+    assert store.get("refresh_families", family_id)["expires_at"] == 1100.0
+    now[0] = 1100.0
+    with pytest.raises(InvalidRefreshToken):
+        tokens.rotate(token)
+
+
+def test_update_refuses_a_record_changed_since_it_was_read(store):
+    # What keeps two refreshes racing with the same token from both winning
+    def family(token_hash):
+        return {"family_id": "f", "user_id": 7, "token_hash": token_hash, "expires_at": 1.0}
+
+    store.put("refresh_families", family("a"))
+    assert store.update("refresh_families", family("b"), expected={"token_hash": "a"})
+    assert not store.update("refresh_families", family("c"), expected={"token_hash": "a"})
+    assert store.get("refresh_families", "f")["token_hash"] == "b"
@@ -0,0 +1,104 @@
+import random
+
+import pytest
+
+from storage import RegistrationTable
+
+
+def registration(user_id, class_id):
+    return {"user_id": user_id, "class_id": class_id}
+
+
+@pytest.fixture
+def table():
+    table = RegistrationTable("registrations", "registrations.json")
+    for user_id, class_id in [(2, 10), (1, 20), (1, 10), (3, 10), (2, 30)]:
+        table.put(registration(user_id, class_id))
+    return table
+
+
+def test_put_keeps_both_columns_sorted(table):
+    assert list(table.values()) == [
+        registration(1, 10), registration(1, 20), registration(2, 10), registration(2, 30), registration(3, 10),
+    ]
+    assert list(table.by_user) == sorted(table.by_user)
+    assert list(table.by_class) == sorted(table.by_class)
+    assert len(table) == 5
+
+
+def test_put_ignores_duplicates(table):
+    table.put(registration(1, 10))
+    assert len(table) == 5
+    assert len(table.by_class) == 5
+
+
+def test_get_and_contains(table):
+    assert table.get((1, 20)) == registration(1, 20)
+    assert table.get((1, 30)) is None
+    assert (2, 30) in table
+    assert (30, 2) not in table
+    assert (1 << 40, 1) not in table
+
+
+def test_delete(table):
+    assert table.delete((1, 10))
+    assert not table.delete((1, 10))
+    assert not table.delete((1 << 40, 1))
+    assert (1, 10) not in table
+    assert table.find("class_id", 10) == [registration(2, 10), registration(3, 10)]
+    assert len(table.by_user) == len(table.by_class) == 4
+
+
+def test_find_by_user_and_class(table):
+    assert table.find("user_id", 1) == [registration(1, 10), registration(1, 20)]
+    assert table.find("user_id", 4) == []
+    assert table.find("class_id", 10) == [registration(1, 10), registration(2, 10), registration(3, 10)]
+    assert table.find("class_id", 1 << 40) == []
+
+
+def test_ranges_stop_at_the_id_limits():
+    table = RegistrationTable("registrations", "registrations.json")
+    low, high = -RegistrationTable.OFFSET, RegistrationTable.OFFSET - 1
+    for user_id, class_id in [(low, low), (low, high), (high, low), (high, high), (0, 0)]:
+        table.put(registration(user_id, class_id))
+    assert table.find("user_id", high) == [registration(high, low), registration(high, high)]
+    assert table.find("user_id", low) == [registration(low, low), registration(low, high)]
+    assert table.find("class_id", high) == [registration(low, high), registration(high, high)]
+
+
+def test_ids_outside_32_bits_are_rejected():
+    table = RegistrationTable("registrations", "registrations.json")
+    with pytest.raises(ValueError):
+        table.put(registration(1 << 40, 1))
+    with pytest.raises(ValueError):
+        table.load([registration(1, RegistrationTable.OFFSET)])
+    assert len(table) == 0
+
+
+def test_page(table):
+    assert table.page(None, 2) == [registration(1, 10), registration(1, 20)]
+    assert table.page((1, 20), 2) == [registration(2, 10), registration(2, 30)]
+    assert table.page((2, 30), 10) == [registration(3, 10)]
+    assert table.page((3, 10), 10) == []
+    # Cursors outside the packable range
+    assert table.page((-(1 << 40), 0), 1) == [registration(1, 10)]
+    assert table.page((1 << 40, 0), 1) == []
+
+
+def test_load_matches_put():
+    pairs = [(random.randrange(-50, 50), random.randrange(100)) for _ in range(2000)]
+    loaded = RegistrationTable("registrations", "registrations.json")
+    loaded.load([registration(*pair) for pair in pairs])
+    put = RegistrationTable("registrations", "registrations.json")
+    for pair in pairs:
+        put.put(registration(*pair))
+    assert loaded.by_user == put.by_user
+    assert loaded.by_class == put.by_class
+    assert len(loaded) == len(set(pairs))
+
+
+def test_load_merges_with_existing_rows(table):
+    table.load([registration(1, 10), registration(4, 40)])
+    assert len(table) == 6
+    assert table.find("class_id", 40) == [registration(4, 40)]
+    assert table.find("user_id", 1) == [registration(1, 10), registration(1, 20)]
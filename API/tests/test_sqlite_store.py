@@ -0,0 +1,62 @@
+from sqlite_storage import SqliteStore
+
+
+def open_pair(tmp_path):
+    # Two workers sharing one database
+    path = str(tmp_path / "coaching.db")
+    return SqliteStore(path), SqliteStore(path)
+
+
+def resets(store):
+    events = []
+    store.subscribe(lambda name, op, payload: op == "reset" and events.append(name))
+    return events
+
+
+def test_other_workers_reset_only_what_changed(tmp_path):
+    a, b = open_pair(tmp_path)
+    events = resets(b)
+    a.insert("registrations", {"user_id": 1, "class_id": 2})
+    b.refresh()
+    assert events == ["registrations"]
+    b.refresh()
+    assert events == ["registrations"]
+
+
+def test_own_writes_are_not_mistaken_for_other_workers(tmp_path):
+    a, b = open_pair(tmp_path)
+    events = resets(b)
+    b.put("users", {"user_id": 1, "username": "b", "hashed_password": "x", "disabled": False, "role": "customer"})
+    b.delete("users", 1)
+    a.put("revocations", {"jti": "j", "expires_at": 1.0})
+    b.refresh()
+    assert events == ["revocations"]
+
+
+def test_writers_catch_up_before_writing(tmp_path):
+    a, b = open_pair(tmp_path)
+    events = resets(b)
+    a.put("revocations", {"jti": "j", "expires_at": 1.0})
+    # b has not refreshed; its own write to the same collection must not
+    # hide a's change
+    b.put("revocations", {"jti": "k", "expires_at": 1.0})
+    assert events == ["revocations"]
+    a.insert("registrations", {"user_id": 1, "class_id": 2})
+    b.refresh()
+    assert events == ["revocations", "registrations"]
+
+
+def test_batch_and_archive_writes_track_their_collections(tmp_path):
+    a, b = open_pair(tmp_path)
+    events = resets(b)
+    b.put("fitness_classes", {"class_id": 1, "coach_id": 1, "start_time": "2020-01-01T10:00:00",
+                              "end_time": "2020-01-01T11:00:00", "class_type": "Yoga"})
+    b.apply_batch("registrations", inserts=[{"user_id": 1, "class_id": 1}])
+    b.delete_unchanged([[
+        ("fitness_classes", "class_id", 1, [b.get("fitness_classes", 1)]),
+        ("registrations", "class_id", 1, b.find("registrations", "class_id", 1)),
+    ]])
+    b.next_id("users")
+    a.put("signing_keys", {"kid": "k", "private_key": "p", "active_from": 0, "expires_at": 1})
+    b.refresh()
+    assert events == ["signing_keys"]